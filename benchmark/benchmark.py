@@ -0,0 +1,448 @@
+"""End to end benchmark on synthetic data.
+
+Writes a synthetic data set with make_data/make_synthetic.py (or reuses one
+made with the same arguments), builds database.duckdb from it one make_data
+stage at a time and then times the /api query paths of server.py against it.
+Every stage runs in a fresh interpreter, which reports its wall time, rows
+per second and peak RSS (of itself and the worker processes it waited for).
+Queries go through the Flask test client with the result cache turned off
+and are summarised as p50/p95/p99 latencies. Everything is written to one
+JSON file, --baseline compares it with an earlier one.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+import numpy as np
+
+repo_dir = Path(__file__).resolve().parents[1]
+make_data_dir = repo_dir / "make_data"
+server_dir = repo_dir / "server"
+
+# Outputs of a previous build in the work directory, removed before building
+build_outputs = [
+    "ghcnd_all",
+    "data/ghcnd_all_parquet",
+    "data/ghcnd_all_parquet.tmp",
+    "data/month_avg_data.csv",
+    "data/default_month_avg_data.csv",
+    "data/station_data.csv",
+    "data/dly_manifest.csv",
+    "data/duckdb_tmp",
+    "db",
+    "database.duckdb",
+    "database.duckdb.wal",
+    "station_matrix",
+    "gazetteer_data/2021_Gaz_place_national",
+    "gazetteer_data/2021_Gaz_zcta_national",
+]
+
+
+def stage_default_ingest(md, args):
+    # make_data.py without --workers: decode the .dly files into monthly
+    # averages in this process. Its CSV is kept apart, the later stages
+    # build from the Parquet ingest. The manifest is recorded like make_data.py
+    # does, but not kept
+    dly_manifest = {}
+    if args.stream:
+        dly_batches = md.tar_dly_batches("ghcnd_all.tar.gz", args.batch_size, dly_manifest)
+    else:
+        shutil.rmtree("ghcnd_all", ignore_errors=True)
+        with tarfile.open("ghcnd_all.tar.gz") as tar_fp:
+            tar_fp.extractall("./ghcnd_all/")
+        dly_batches = md.dir_dly_batches("ghcnd_all", args.batch_size, dly_manifest)
+    md.dly_month_avg_to_csv(dly_batches, "data/default_month_avg_data.csv", args.elements)
+
+
+def stage_ingest(md, args):
+    # The manifest is recorded during the ingest, like make_data.py does
+    dly_manifest = {}
+    if args.stream:
+        dly_batches = md.tar_dly_batches("ghcnd_all.tar.gz", args.batch_size, dly_manifest)
+    else:
+        shutil.rmtree("ghcnd_all", ignore_errors=True)
+        with tarfile.open("ghcnd_all.tar.gz") as tar_fp:
+            tar_fp.extractall("./ghcnd_all/")
+        dly_batches = md.dir_dly_batches("ghcnd_all", args.batch_size, dly_manifest)
+    md.dly_to_parquet(dly_batches, "data/ghcnd_all_parquet", args.workers)
+    md.save_dly_manifest(dly_manifest, "data/dly_manifest.csv")
+
+
+def stage_month_avg(md, args):
+    md.parquet_month_avg_to_csv("data/ghcnd_all_parquet", "data/month_avg_data.csv", args.elements)
+
+
+def stage_stations(md, args):
+    md.stations_to_csv("data/ghcnd-stations.txt", "data/station_data.csv")
+
+
+def stage_loc_to_temp(md, args):
+    con = md.build_connection(args.memory_limit, args.temp_dir)
+    md.loc_to_temp_to_parquet(
+        "data/month_avg_data.csv", "data/station_data.csv", "db/loc_to_temp_db.parquet",
+        args.elements, con,
+    )
+    con.close()
+
+
+def stage_gazetteer(md, args):
+    md.gazetteer_to_parquet("2021_Gaz_place_national", False)
+    md.gazetteer_to_parquet("2021_Gaz_zcta_national")
+
+
+def stage_station_tables(md, args):
+    con = md.build_connection(args.memory_limit, args.temp_dir, "database.duckdb", args.row_group_size)
+    md.create_station_tables(
+        con, md.read_table_sql("db/loc_to_temp_db.parquet"), args.elements,
+        md.read_table_sql("data/station_data.csv"),
+    )
+    con.execute(
+        "CREATE TABLE place_names AS SELECT * FROM read_parquet('db/2021_Gaz_place_national.parquet')"
+    )
+    con.execute(
+        "CREATE TABLE place_zips AS SELECT * FROM read_parquet('db/2021_Gaz_zcta_national.parquet')"
+    )
+    md.create_macros(con)
+    con.close()
+
+
+def stage_place_series(md, args):
+    con = md.build_connection(args.memory_limit, args.temp_dir, "database.duckdb")
+    md.build_place_series(con, args.elements, args.workers)
+    con.close()
+
+
+def stage_derived_tables(md, args):
+    con = md.build_connection(args.memory_limit, args.temp_dir, "database.duckdb")
+    md.build_derived_tables(con, args.elements)
+    con.close()
+
+
+def stage_station_matrix(md, args):
+    con = md.build_connection(args.memory_limit, args.temp_dir, "database.duckdb")
+    md.export_station_matrix(con, args.elements)
+    con.close()
+
+
+# make_data.py's build in order, with the query counting the rows each stage
+# produced (database.duckdb is attached as db). default_ingest is the build
+# without --workers, timed for comparison, the rest is the --workers build
+stages = {
+    "default_ingest": (
+        stage_default_ingest, "SELECT count(*) FROM read_csv_auto('data/default_month_avg_data.csv')"
+    ),
+    "ingest": (stage_ingest, "SELECT count(*) FROM read_parquet('data/ghcnd_all_parquet/*/*.parquet')"),
+    "month_avg": (stage_month_avg, "SELECT count(*) FROM read_csv_auto('data/month_avg_data.csv')"),
+    "stations": (stage_stations, "SELECT count(*) FROM read_csv_auto('data/station_data.csv')"),
+    "loc_to_temp": (stage_loc_to_temp, "SELECT count(*) FROM read_parquet('db/loc_to_temp_db.parquet')"),
+    "gazetteer": (
+        stage_gazetteer,
+        "SELECT (SELECT count(*) FROM read_parquet('db/2021_Gaz_place_national.parquet')) "
+        "+ (SELECT count(*) FROM read_parquet('db/2021_Gaz_zcta_national.parquet'))",
+    ),
+    "station_tables": (stage_station_tables, "SELECT count(*) FROM db.station_year_temp"),
+    "place_series": (stage_place_series, "SELECT count(*) FROM db.place_series"),
+    "derived_tables": (stage_derived_tables, "SELECT count(*) FROM db.grid_yearly"),
+    "station_matrix": (stage_station_matrix, "SELECT count(*) FROM db.station_year_temp"),
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in bytes on macOS and KiB everywhere else
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+    return max(
+        resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    ) / scale
+
+
+def run_stage(name, bench_args):
+    # Runs inside the child started by measure_stage, in the work directory
+    sys.path.insert(0, str(make_data_dir))
+    import duckdb as ddb
+    import make_data as md
+
+    build_args = md.parse_args(
+        ["--workers", str(bench_args.workers), "--batch-size", str(bench_args.batch_size)]
+        + (["--stream"] if bench_args.stream else [])
+    )
+    Path("data").mkdir(exist_ok=True, parents=True)
+    Path("db").mkdir(exist_ok=True, parents=True)
+    stage_fn, count_sql = stages[name]
+    t_start = time.perf_counter()
+    stage_fn(md, build_args)
+    seconds = time.perf_counter() - t_start
+    rss_mb = peak_rss_mb()
+    con = ddb.connect()
+    if Path("database.duckdb").is_file():
+        con.execute("ATTACH 'database.duckdb' AS db (READ_ONLY)")
+    rows = con.execute(count_sql).fetchone()[0]
+    con.close()
+    return {"seconds": seconds, "rows": rows, "rows_per_sec": rows / seconds, "peak_rss_mb": rss_mb}
+
+
+def query_sets(server, n_queries, seed):
+    # (method, url, json body) of every request, by query path
+    rng = np.random.default_rng(seed)
+    st_lat, st_long = server.station_data["Latitude"], server.station_data["Longitude"]
+
+    def near_station_points(n):
+        # Close to a random station, so the lookups find data
+        inds = rng.integers(0, len(st_lat), n)
+        return st_lat[inds] + rng.normal(0, 0.2, n), st_long[inds] + rng.normal(0, 0.2, n)
+
+    def loc_urls(path, extra=None):
+        return [
+            ("GET", f"{path}?{urlencode({'lat': f'{lat:.4f}', 'long': f'{long:.4f}', **(extra or {})})}", None)
+            for lat, long in zip(*near_station_points(n_queries))
+        ]
+
+    zips = np.flatnonzero(~np.isnan(server.zip_coords[:, 0]))
+    places = sorted(server.place_coords)
+    n_batches = max(n_queries // 10, 5)
+    batch_bodies = []
+    for _ in range(n_batches):
+        lats, longs = near_station_points(100)
+        batch_bodies.append({"locations": [
+            {"lat": float(lat), "long": float(long)} for lat, long in zip(lats, longs)
+        ]})
+    return {
+        "loc": loc_urls("/api/loc"),
+        "loc_wide": loc_urls("/api/loc", {"radius": 250}),
+        "loc_trend": loc_urls("/api/loc/trend", {"start_year": 1980}),
+        "loc_zip": [
+            ("GET", f"/api/loc?zip={z:05d}", None) for z in rng.choice(zips, n_queries)
+        ] if len(zips) else [],
+        "loc_place": [
+            ("GET", f"/api/loc?{urlencode({'city': places[ii][1], 'state': places[ii][0]})}", None)
+            for ii in rng.integers(0, len(places), n_queries)
+        ] if places else [],
+        "everywhere": [("GET", "/api/everywhere", None)] * n_queries,
+        "batch_100": [("POST", "/api/batch", body) for body in batch_bodies],
+    }
+
+
+def run_queries(bench_args):
+    # Runs inside the child started by measure_queries, in the work directory
+    sys.path.insert(0, str(server_dir))
+    t_start = time.perf_counter()
+    import server
+    import_seconds = time.perf_counter() - t_start
+
+    client = server.app.test_client()
+    results = {}
+    for name, requests in query_sets(server, bench_args.queries, bench_args.seed).items():
+        # A few untimed requests first, so lazy imports and cold pages don't count
+        for method, url, body in requests[:5]:
+            client.open(url, method=method, json=body)
+        times = []
+        n_errors = 0
+        for method, url, body in requests:
+            t_start = time.perf_counter()
+            rsp = client.open(url, method=method, json=body)
+            times.append(time.perf_counter() - t_start)
+            n_errors += rsp.status_code != 200
+        if not times:
+            continue
+        p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1000
+        results[name] = {
+            "n": len(times),
+            "errors": n_errors,
+            "mean_ms": float(np.mean(times)) * 1000,
+            "p50_ms": float(p50),
+            "p95_ms": float(p95),
+            "p99_ms": float(p99),
+        }
+    return {"import_seconds": import_seconds, "peak_rss_mb": peak_rss_mb(), "paths": results}
+
+
+def run_child(child_args, work_dir, env=None):
+    out = subprocess.run(
+        [sys.executable, str(Path(__file__).resolve())] + child_args,
+        cwd=work_dir, env=env, stdout=subprocess.PIPE, text=True, check=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def bench_child_args(args):
+    return [
+        "--workers", str(args.workers), "--batch-size", str(args.batch_size),
+        "--queries", str(args.queries), "--seed", str(args.seed),
+    ] + (["--stream"] if args.stream else [])
+
+
+def generate(args, work_dir):
+    # Reuses the data set in work_dir when it was made with the same arguments
+    wanted = {
+        "stations": args.stations, "first_year": args.first_year,
+        "last_year": args.last_year, "seed": args.seed,
+    }
+    info_file = work_dir / "synthetic.json"
+    if info_file.is_file():
+        info = json.loads(info_file.read_text())
+        if {k: info.get(k) for k in wanted} == wanted:
+            return {**info, "seconds": None, "reused": True}
+    t_start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable, str(make_data_dir / "make_synthetic.py"),
+            "--stations", str(args.stations), "--first-year", str(args.first_year),
+            "--last-year", str(args.last_year), "--seed", str(args.seed),
+            "--workers", str(args.workers), "--out-dir", str(work_dir),
+        ],
+        check=True,
+    )
+    seconds = time.perf_counter() - t_start
+    return {**json.loads(info_file.read_text()), "seconds": seconds, "reused": False}
+
+
+def clean_build(work_dir):
+    for name in build_outputs:
+        path = work_dir / name
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink(missing_ok=True)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=repo_dir, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=repo_dir, capture_output=True, text=True, check=True,
+        ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def compare_to_baseline(result, baseline, max_slowdown):
+    # Stage times and query p95s that got slower than max_slowdown times
+    # the baseline's, every shared metric is printed
+    pairs = [
+        (f"stage {name} (s)", baseline["stages"][name]["seconds"], stage["seconds"])
+        for name, stage in result["stages"].items() if name in baseline.get("stages", {})
+    ]
+    for backend, queries in result["queries"].items():
+        base_paths = baseline.get("queries", {}).get(backend, {}).get("paths", {})
+        pairs += [
+            (f"{backend} {name} p95 (ms)", base_paths[name]["p95_ms"], path["p95_ms"])
+            for name, path in queries["paths"].items() if name in base_paths
+        ]
+    slower = []
+    mnl = max((len(label) for label, _, _ in pairs), default=0)
+    print(f"Compared with {baseline.get('commit') or 'baseline'}")
+    for label, before, now in pairs:
+        ratio = now / before if before else float("inf")
+        print(f"{label:{mnl}}  {before:10.3f}  {now:10.3f}  {ratio:6.2f}x")
+        if max_slowdown is not None and ratio > max_slowdown:
+            slower.append(label)
+    return slower
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark make_data.py and server.py on synthetic data")
+    parser.add_argument("--stations", type=int, default=1000,
+                        help="stations of the synthetic data set, 1k to 200k (default 1000)")
+    parser.add_argument("--first-year", type=int, default=1950)
+    parser.add_argument("--last-year", type=int, default=2023)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None,
+                        help="where the data set and build go (default bench_data/<stations>_<seed>)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="make_data.py --workers (default one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="make_data.py --batch-size")
+    parser.add_argument("--stream", action="store_true",
+                        help="ingest straight from ghcnd_all.tar.gz like make_data.py --stream")
+    parser.add_argument("--queries", type=int, default=300,
+                        help="requests per query path (batches get a tenth)")
+    parser.add_argument("--backends", default="sql,matrix",
+                        help="comma separated GW_LOC_BACKEND values to time the queries with")
+    parser.add_argument("--skip-build", action="store_true",
+                        help="only time the queries, against the database already in --work-dir")
+    parser.add_argument("--out", default=None,
+                        help="JSON results file (default benchmark_<commit>_<stations>.json)")
+    parser.add_argument("--baseline", default=None,
+                        help="earlier results file to compare with")
+    parser.add_argument("--max-slowdown", type=float, default=None,
+                        help="exit with 1 when a stage or query p95 is this many times the baseline's")
+    parser.add_argument("--stage", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--run-queries", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Children print their measurements as the last line of their output
+    if args.stage is not None:
+        print(json.dumps(run_stage(args.stage, args)))
+        return 0
+    if args.run_queries:
+        print(json.dumps(run_queries(args)))
+        return 0
+
+    work_dir = Path(args.work_dir or f"bench_data/{args.stations}_{args.seed}").resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+    commit, dirty = git_commit()
+    result = {
+        "commit": commit,
+        "dirty": dirty,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "config": {k: v for k, v in vars(args).items() if k not in ("stage", "run_queries")},
+        "stages": {},
+        "queries": {},
+    }
+
+    if not args.skip_build:
+        print("Generating Synthetic Data")
+        result["generate"] = generate(args, work_dir)
+        clean_build(work_dir)
+        for name in stages:
+            print(f"Running {name}")
+            stage = run_child(["--stage", name] + bench_child_args(args), work_dir)
+            result["stages"][name] = stage
+            print(f"  {stage['seconds']:.2f}s, {stage['rows']} rows, "
+                  f"{stage['rows_per_sec']:.0f} rows/s, {stage['peak_rss_mb']:.0f}MB peak RSS")
+
+    for backend in args.backends.split(","):
+        print(f"Timing Queries ({backend} backend)")
+        env = {**os.environ, "GW_LOC_BACKEND": backend, "GW_LOC_CACHE_SIZE": "0"}
+        queries = run_child(["--run-queries"] + bench_child_args(args), work_dir, env)
+        result["queries"][backend] = queries
+        for name, path in queries["paths"].items():
+            print(f"  {name:12s} p50 {path['p50_ms']:8.2f}ms  p95 {path['p95_ms']:8.2f}ms  "
+                  f"p99 {path['p99_ms']:8.2f}ms  {path['errors']} errors")
+
+    out = args.out or f"benchmark_{(commit or 'nocommit')[:12]}_{args.stations}.json"
+    with open(out, "w") as fp:
+        json.dump(result, fp, indent=2)
+    print(f"Results written to {out}")
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            slower = compare_to_baseline(result, json.load(fp), args.max_slowdown)
+        if slower:
+            print(f"Slower than {args.max_slowdown}x the baseline: {', '.join(slower)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
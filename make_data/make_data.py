@@ -1,8 +1,15 @@
+import argparse
+import hashlib
+import json
 import os
 import shutil
 import tarfile
+import time
 import urllib.request as request
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 from contextlib import closing
+from functools import partial
 from pathlib import Path
 from zipfile import ZipFile
 
@@ -542,6 +549,53 @@ ghcnd_all_fwf_widths = [
     1,
 ]
 
+# Elements aggregated into loc_to_temp, TMAX is stored as the Average column
+ghcnd_default_elements = ["TMAX", "TMIN", "TAVG", "PRCP"]
+
+# Elements the element list above gives in whole units (mm, cm, km, degrees,
+# percent, minutes or days), every other element is in tenths of its unit
+ghcnd_whole_unit_elements = {
+    "SNOW", "SNWD", "AWDR", "DAEV", "DAPR", "DASF", "DATN", "DATX", "DAWM", "DWPR",
+    "FRGB", "FRGT", "FRTH", "GAHT", "MDWM", "PSUN", "TSUN", "WDF1", "WDF2",
+    "WDF5", "WDFG", "WDFI", "WDFM", "WDMV",
+}
+
+station_meta_cols = [
+    "ID",
+    "Name",
+    "Latitude",
+    "Longitude",
+    "Elevation",
+    "State",
+    "GSNFlag",
+    "HCNCRNFlag",
+    "WMOID",
+]
+
+# 3-D unit vector of a station, two stations are within an angle th of each
+# other when the dot product of their vectors is at least cos(th)
+station_unit_vector_sql = """
+    cos(radians(Latitude)) * cos(radians(Longitude)) AS x,
+    cos(radians(Latitude)) * sin(radians(Longitude)) AS y,
+    sin(radians(Latitude)) AS z
+"""
+
+ghcnd_all_fwf_offsets = np.cumsum([0] + ghcnd_all_fwf_widths)
+ghcnd_all_line_len = int(ghcnd_all_fwf_offsets[-1])
+# (31, 5) byte positions of Value1 ... Value31 inside a .dly line
+ghcnd_all_value_cols = np.array(
+    [
+        np.arange(ghcnd_all_fwf_offsets[ii], ghcnd_all_fwf_offsets[ii + 1])
+        for ii, k in enumerate(ghcnd_all_fwf_header)
+        if k.startswith("Value")
+    ]
+)
+# Names and byte positions of the one character MFlag/QFlag/SFlag fields
+ghcnd_all_flag_names = [k for k in ghcnd_all_fwf_header if "Flag" in k]
+ghcnd_all_flag_cols = np.array(
+    [ghcnd_all_fwf_offsets[ghcnd_all_fwf_header.index(k)] for k in ghcnd_all_flag_names]
+)
+
 """
 ID         is the station identification code.  Note that the first two
            characters denote the FIPS  country code, the third character 
@@ -648,10 +702,25 @@ def download_ftp_file(in_url, in_filename):
             shutil.copyfileobj(r, f)
 
 
-def download_and_extract(in_url, in_filename, in_dir, is_zip=True):
+def download_once(in_url, in_filename):
     if not Path(in_filename).is_file():
         download_ftp_file(in_url, in_filename)
 
+
+def download_fresh(in_url, in_filename):
+    # The old file stays in place until the new one is complete, so a
+    # failed transfer doesn't leave the build without it
+    try:
+        download_ftp_file(in_url, f"{in_filename}.tmp")
+    except BaseException:
+        Path(f"{in_filename}.tmp").unlink(missing_ok=True)
+        raise
+    os.replace(f"{in_filename}.tmp", in_filename)
+
+
+def download_and_extract(in_url, in_filename, in_dir, is_zip=True):
+    download_once(in_url, in_filename)
+
     if not Path(in_dir).is_dir():
         if is_zip:
             with ZipFile(in_filename) as zip_ref:
@@ -701,44 +770,1112 @@ def data_file_exist(in_filename, p_dir="data"):
     return file_path.exists() and file_path.is_file()
 
 
-def main():
+def batched(in_list, batch_size):
+    for i in range(0, len(in_list), batch_size):
+        yield in_list[i : i + batch_size]
+
+
+def dly_manifest_entry(size, mtime, buf):
+    # (size, mtime, content hash) a station file is recorded with
+    return size, mtime, hashlib.sha256(buf).hexdigest()
+
+
+def dir_dly_batches(in_dir, batch_size, manifest=None):
+    # Paths, unless manifest is given: then every file is read here once,
+    # recorded in manifest and handed on as its bytes
+    dly_files = sorted(Path(in_dir).rglob("*.dly"))
+    if manifest is None:
+        yield from batched([str(f_l) for f_l in dly_files], batch_size)
+        return
+    for b_files in batched(dly_files, batch_size):
+        batch = []
+        for f_l in b_files:
+            f_stat = f_l.stat()
+            buf = read_dly_bytes(str(f_l))
+            manifest[f_l.stem] = dly_manifest_entry(f_stat.st_size, int(f_stat.st_mtime), buf)
+            batch.append(buf)
+        yield batch
+
+
+def tar_dly_batches(in_filename, batch_size, manifest=None):
+    # "r|*" reads the archive as a forward-only stream, members are
+    # never written to disk and only one batch is held in memory. The
+    # manifest entry of every member goes into manifest, when given, so
+    # recording it takes no second pass over the archive
+    batch = []
+    with tarfile.open(in_filename, mode="r|*") as tar_fp:
+        for member in tar_fp:
+            if not (member.isfile() and member.name.endswith(".dly")):
+                continue
+            batch.append(tar_fp.extractfile(member).read())
+            if manifest is not None:
+                manifest[Path(member.name).stem] = dly_manifest_entry(
+                    member.size, int(member.mtime), batch[-1]
+                )
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def bounded_map(pool, fn, in_iter, max_pending):
+    # Like pool.map, but only pulls from in_iter as results are consumed
+    pending = deque()
+    for item in in_iter:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def dly_batch_to_parquet(batch_args):
+    # Runs inside a worker process, so it only gets picklable arguments.
+    # Sources are either .dly file paths or the raw bytes of a .dly file
+    batch_num, dly_sources, out_dir = batch_args
+    batch_df = dly_batch_frame(dly_sources)
+    # The first two characters of a station ID are its FIPS country code
+    for country, c_df in batch_df.groupby(batch_df["ID"].str[:2]):
+        part_dir = Path(out_dir) / f"country={country}"
+        part_dir.mkdir(exist_ok=True, parents=True)
+        c_df.to_parquet(
+            part_dir / f"part-{batch_num:06d}.parquet",
+            index=False,
+            compression="zstd",
+        )
+    return len(batch_df)
+
+
+def dly_to_parquet(dly_batches, out_dir, workers):
+    tmp_dir = Path(f"{out_dir}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    jobs = (
+        (b_num, b_sources, str(tmp_dir))
+        for b_num, b_sources in enumerate(dly_batches)
+    )
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for _ in tqdm(
+            bounded_map(pool, dly_batch_to_parquet, jobs, 2 * workers), unit="batch"
+        ):
+            pass
+    # Only publish the shards once every batch made it, so a crashed run is redone
+    tmp_dir.rename(out_dir)
+
+
+def parquet_month_avg_to_csv(parquet_dir, out_csv, elements):
+    values = ",".join(f"Value{ii}" for ii in range(1, 32))
+    element_list = ",".join(f"'{element}'" for element in elements)
+    con = ddb.connect()
+    con.execute(
+        f"""
+        COPY (
+            SELECT ID, Year, Month, Element, Average FROM (
+                SELECT ID, Year, Month, Element,
+                    list_avg(list_filter([{values}], v -> v >= -1000)) AS Average
+                FROM read_parquet('{parquet_dir}/*/*.parquet')
+                WHERE Element IN ({element_list})
+            ) WHERE Average IS NOT NULL
+        ) TO '{out_csv}' (HEADER, DELIMITER ',')
+        """
+    )
+    con.close()
+
+
+def read_dly_bytes(src):
+    if isinstance(src, bytes):
+        return src
+    with open(src, "rb") as fp:
+        return fp.read()
+
+
+def fwf_digits_to_int(in_chars):
+    # Right aligned integer fields: blanks and the sign only ever come before
+    # the digits, so the digits can be weighted by their position directly
+    is_digit = (in_chars >= ord("0")) & (in_chars <= ord("9"))
+    digits = np.where(is_digit, in_chars - ord("0"), 0).astype(np.int64)
+    weights = 10 ** np.arange(in_chars.shape[-1] - 1, -1, -1, dtype=np.int64)
+    vals = (digits * weights).sum(axis=-1)
+    return np.where((in_chars == ord("-")).any(axis=-1), -vals, vals)
+
+
+def decode_dly(buf, with_flags=False):
+    rows = np.array(buf.splitlines(), dtype=f"S{ghcnd_all_line_len}")
+    rows = rows.view(np.uint8).reshape(-1, ghcnd_all_line_len)
+    off = ghcnd_all_fwf_offsets
+    dly = {
+        "ID": np.ascontiguousarray(rows[:, off[0] : off[1]]).view("S11").ravel(),
+        "Year": fwf_digits_to_int(rows[:, off[1] : off[2]]),
+        "Month": fwf_digits_to_int(rows[:, off[2] : off[3]]),
+        "Element": np.ascontiguousarray(rows[:, off[3] : off[4]]).view("S4").ravel(),
+        "Values": fwf_digits_to_int(rows[:, ghcnd_all_value_cols]),
+    }
+    if with_flags:
+        # (lines, 93) raw bytes in ghcnd_all_flag_names order
+        dly["Flags"] = rows[:, ghcnd_all_flag_cols]
+    return dly
+
+
+def dly_batch_frame(dly_sources):
+    # The daily rows of a batch with the columns of ghcnd_all_fwf_header,
+    # decoded in one pass over the joined files. Flags are categoricals of
+    # the characters in the batch, blanks are missing like read_fwf made them
+    buf = b"".join(read_dly_bytes(src).rstrip(b"\r\n") + b"\n" for src in dly_sources)
+    dly = decode_dly(buf, with_flags=True)
+    cols = {
+        "ID": dly["ID"].astype(str),
+        "Year": dly["Year"].astype(np.int16),
+        "Month": dly["Month"].astype(np.int8),
+        "Element": dly["Element"].astype(str),
+    }
+    values = dly["Values"].astype(np.int32)
+    for ii in range(values.shape[1]):
+        cols[f"Value{ii + 1}"] = values[:, ii]
+    chars = np.setdiff1d(np.unique(dly["Flags"]), [ord(" ")])
+    codes = np.full(256, -1, dtype=np.int16)
+    codes[chars] = np.arange(len(chars))
+    flag_codes = codes[dly["Flags"]]
+    categories = [chr(c) for c in chars]
+    for ii, k in enumerate(ghcnd_all_flag_names):
+        cols[k] = pd.Categorical.from_codes(flag_codes[:, ii], categories)
+    return pd.DataFrame(cols)[ghcnd_all_fwf_header]
+
+
+def dly_month_averages(buf, elements=("TMAX",)):
+    # Every requested element comes out of the same decoded buffer
+    dly = decode_dly(buf)
+    is_element = np.isin(dly["Element"], [element.encode() for element in elements])
+    values = dly["Values"][is_element]
+    # Missing days are -9999, anything below -1000 is skipped
+    is_valid = values >= -1000
+    n_valid = is_valid.sum(axis=1)
+    total = np.where(is_valid, values, 0).sum(axis=1)
+    has_data = n_valid > 0
+    return pd.DataFrame(
+        {
+            "ID": dly["ID"][is_element][has_data].astype(str),
+            "Year": dly["Year"][is_element][has_data],
+            "Month": dly["Month"][is_element][has_data],
+            "Element": dly["Element"][is_element][has_data].astype(str),
+            "Average": total[has_data] / n_valid[has_data],
+        }
+    )
+
+
+def dly_batch_month_averages(dly_sources, elements):
+    return pd.concat(
+        [dly_month_averages(read_dly_bytes(src), elements) for src in dly_sources],
+        ignore_index=True,
+    )
+
+
+def dly_month_avg_to_csv(dly_batches, out_csv, elements):
+    with open(out_csv, "w") as wfp:
+        wfp.write("ID,Year,Month,Element,Average\n")
+        for b_sources in tqdm(dly_batches, unit="batch"):
+            m_avg = dly_batch_month_averages(b_sources, elements)
+            # Python floats keep the repr the line by line builder wrote
+            wfp.writelines(
+                f"{s_id},{year},{month},{element},{avg}\n"
+                for s_id, year, month, element, avg in zip(
+                    m_avg["ID"].tolist(),
+                    m_avg["Year"].tolist(),
+                    m_avg["Month"].tolist(),
+                    m_avg["Element"].tolist(),
+                    m_avg["Average"].tolist(),
+                )
+            )
+
+
+def stations_to_csv(in_filename, out_csv):
+    fwf_check = pd.read_fwf(
+        in_filename,
+        widths=[11, 9, 10, 7, 3, 31, 4, 4, 6],
+        header=None,
+    )
+    fwf_check.to_csv(
+        out_csv,
+        index=False,
+        mode="w",
+        sep=",",
+        encoding="utf-8-sig",
+        header=ghcnd_stations_fwf_header,
+    )
+
+
+def element_scale(element):
+    # Divisor from the stored GHCN values to the element's unit
+    return 1.0 if element in ghcnd_whole_unit_elements else 10.0
+
+
+def element_col(element):
+    # TMAX keeps its historical Average column name
+    return "Average" if element == "TMAX" else element
+
+
+def read_table_sql(in_filename):
+    if str(in_filename).endswith(".parquet"):
+        return f"read_parquet('{in_filename}')"
+    return f"read_csv_auto('{in_filename}', header=true)"
+
+
+def yearly_loc_to_temp_sql(month_src, station_src, elements):
+    # One row per station year with one column per element, the yearly
+    # value is the mean of the monthly means like the old pandas groupby
+    element_cols = ",\n".join(
+        f"(AVG(Average) FILTER (WHERE Element = '{element}') / {element_scale(element)})::REAL "
+        f"AS {element_col(element)}"
+        for element in elements
+    )
+    return f"""
+        WITH y_avg_temp AS (
+            SELECT ID, Year::SMALLINT AS Year, {element_cols}
+            FROM {month_src}
+            GROUP BY ID, Year
+        )
+        SELECT y_avg_temp.* EXCLUDE (ID, Year), s_data.* EXCLUDE (ID),
+            y_avg_temp.ID, y_avg_temp.Year
+        FROM y_avg_temp LEFT JOIN {station_src} AS s_data ON y_avg_temp.ID = s_data.ID
+    """
+
+
+def build_connection(memory_limit=None, temp_dir=None, database=None, row_group_size=None):
+    # Lets DuckDB spill to temp_dir instead of growing past memory_limit
+    config = {}
+    if memory_limit is not None:
+        config["memory_limit"] = memory_limit
+    if temp_dir is not None:
+        Path(temp_dir).mkdir(exist_ok=True, parents=True)
+        config["temp_directory"] = str(temp_dir)
+    con = ddb.connect(config=config)
+    if database is not None:
+        # Smaller row groups give the min/max zone maps finer ranges to prune
+        rg_option = f" (ROW_GROUP_SIZE {row_group_size})" if row_group_size else ""
+        con.execute(f"ATTACH '{database}' AS build_db{rg_option}")
+        con.execute("USE build_db")
+    return con
+
+
+# zstd packs the small REAL and SMALLINT columns much tighter than the
+# default snappy. The row group size is DuckDB's default, spelled out: on a
+# 4.8M row file 16384 to 1966080 rows were all within 1% in size, and a
+# single station read_parquet was fastest at 61440 and 122880
+parquet_copy_options = "FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 122880"
+
+
+def loc_to_temp_to_parquet(month_csv, station_csv, out_parquet, elements, con):
+    y_sql = yearly_loc_to_temp_sql(
+        read_table_sql(month_csv), read_table_sql(station_csv), elements
+    )
+    con.execute(f"COPY ({y_sql}) TO '{out_parquet}.tmp' ({parquet_copy_options})")
+    os.replace(f"{out_parquet}.tmp", out_parquet)
+
+
+def hilbert_index(lat, long, order=16):
+    # Position along a Hilbert curve over a 2^order x 2^order lat/long grid,
+    # see https://en.wikipedia.org/wiki/Hilbert_curve
+    n = 1 << order
+    x = (np.nan_to_num(np.asarray(long, dtype=float)) + 180.0) / 360.0 * n
+    y = (np.nan_to_num(np.asarray(lat, dtype=float)) + 90.0) / 180.0 * n
+    x = np.clip(x.astype(np.int64), 0, n - 1)
+    y = np.clip(y.astype(np.int64), 0, n - 1)
+    d = np.zeros_like(x)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry)
+        flip = rx & ~ry
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+def create_station_tables(con, loc_src, elements, station_src=None):
+    # Station metadata is stored once in stations and the station years only
+    # carry a small integer key, loc_to_temp stays available as a view.
+    # Keys follow a Hilbert curve, so nearby stations have nearby keys and
+    # a radius query touches only a few row groups of station_year_temp.
+    # Columns get the smallest type that holds them: SMALLINT years, REAL
+    # values and an ENUM of every state in station_src (all stations, so
+    # incremental builds can add stations without widening the type)
+    meta_cols = ", ".join(station_meta_cols)
+    fact_cols = ", ".join(
+        f"{element_col(element)}::REAL AS {element_col(element).lower()}"
+        for element in elements
+    )
+    con.execute(
+        f"""
+        CREATE TYPE state_code AS ENUM (
+            SELECT DISTINCT State::VARCHAR FROM {station_src or loc_src}
+            WHERE State IS NOT NULL ORDER BY 1
+        )
+        """
+    )
+    st_meta = con.execute(f"SELECT DISTINCT {meta_cols} FROM {loc_src}").df()
+    st_meta["Hilbert"] = hilbert_index(st_meta["Latitude"], st_meta["Longitude"])
+    st_meta = st_meta.sort_values(["Hilbert", "ID"], ignore_index=True)
+    st_meta.insert(0, "station_key", np.arange(len(st_meta), dtype=np.int32))
+    con.register("st_meta", st_meta.drop(columns=["Hilbert"]))
+    con.execute(
+        f"""
+        CREATE TABLE stations AS
+        SELECT * REPLACE (
+                station_key::INTEGER AS station_key,
+                Elevation::REAL AS Elevation,
+                State::state_code AS State,
+                WMOID::INTEGER AS WMOID
+            ),
+            {station_unit_vector_sql}
+        FROM st_meta ORDER BY station_key
+        """
+    )
+    con.unregister("st_meta")
+    con.execute(
+        f"""
+        CREATE TABLE station_year_temp AS
+        SELECT stations.station_key, loc.Year::SMALLINT AS year, {fact_cols}
+        FROM {loc_src} AS loc JOIN stations ON loc.ID = stations.ID
+        ORDER BY stations.station_key, loc.Year
+        """
+    )
+    create_loc_to_temp_view(con, elements)
+
+
+def create_loc_to_temp_view(con, elements):
+    view_cols = ", ".join(
+        f"t.{element_col(element).lower()} AS {element_col(element)}"
+        for element in elements
+    )
+    meta_cols = ", ".join(f"s.{col}" for col in station_meta_cols[1:])
+    con.execute(
+        f"""
+        CREATE OR REPLACE VIEW loc_to_temp AS
+        SELECT {view_cols}, {meta_cols}, s.ID, t.year AS Year
+        FROM station_year_temp AS t JOIN stations AS s ON t.station_key = s.station_key
+        """
+    )
+
+
+# Cell sizes in degrees of the grid pyramid, coarsest first. Each level
+# splits every cell of the one above into 4, cells are numbered row major
+# from (-90, -180) and the level is kept in the high bits of cell_key
+grid_cell_degrees = [2.0, 1.0, 0.5]
+
+
+def grid_cell_key_sql(level, lat_col, long_col):
+    size = grid_cell_degrees[level]
+    n_rows, n_cols = round(180 / size), round(360 / size)
+    row = f"least(floor(({lat_col} + 90) / {size})::BIGINT, {n_rows - 1})"
+    col = f"least(floor(({long_col} + 180) / {size})::BIGINT, {n_cols - 1})"
+    return f"(({level}::BIGINT << 32) + {row} * {n_cols} + {col})"
+
+
+def build_derived_tables(con, elements):
+    # Tables computed from station_year_temp, rebuilt after every update.
+    # global_yearly keeps sums and counts, so averages over it can be re-weighted
+    agg_cols = ", ".join(
+        f"count({col})::INTEGER AS n_{col}, sum({col})::DOUBLE AS sum_{col}"
+        for col in (element_col(element).lower() for element in elements)
+    )
+    con.execute(
+        f"""
+        CREATE OR REPLACE TABLE global_yearly AS
+        SELECT year, {agg_cols}
+        FROM station_year_temp
+        GROUP BY year
+        ORDER BY year
+        """
+    )
+    # Years with data of every station per element, so the server can list
+    # just the stations that contribute to a grid_yearly lookup
+    n_cols = ", ".join(
+        f"count({col})::INTEGER AS n_{col}"
+        for col in (element_col(element).lower() for element in elements)
+    )
+    con.execute(
+        f"""
+        CREATE OR REPLACE TABLE station_elements AS
+        SELECT station_key, {n_cols}
+        FROM station_year_temp
+        GROUP BY station_key
+        ORDER BY station_key
+        """
+    )
+    # Yearly sums and counts of the stations in each grid cell at every
+    # level, so the server can add up cells lying inside a radius
+    grid_levels = " UNION ALL ".join(
+        f"""
+        SELECT {grid_cell_key_sql(level, "s.Latitude", "s.Longitude")} AS cell_key, t.*
+        FROM station_year_temp AS t JOIN stations AS s ON t.station_key = s.station_key
+        WHERE s.Latitude IS NOT NULL AND s.Longitude IS NOT NULL
+        """
+        for level in range(len(grid_cell_degrees))
+    )
+    con.execute(
+        f"""
+        CREATE OR REPLACE TABLE grid_yearly AS
+        SELECT cell_key, year, {agg_cols}
+        FROM ({grid_levels})
+        GROUP BY cell_key, year
+        ORDER BY cell_key, year
+        """
+    )
+    # New id on every build, the server derives its ETags from it
+    con.execute(
+        """
+        CREATE OR REPLACE TABLE build_info AS
+        SELECT gen_random_uuid()::VARCHAR AS build_id, now() AS built_at
+        """
+    )
+
+
+# Same radius as the server's /loc lookups
+place_radius_miles = 35.
+miles_per_degree = 69.
+
+# Per process copy of the station data, set by init_place_worker
+place_worker_data = {}
+
+
+def great_arc_degrees(long1, lat1, long2, lat2):
+    # NumPy version of the gad macro, term for term so the station sets match
+    dhav = lambda th: np.sin(np.radians(th) / 2) ** 2
+    dlat = np.abs(np.asarray(lat2) - lat1)
+    dlong = np.abs(np.asarray(long2) - long1)
+    th = dhav(dlat) + (1 - dhav(dlat) - dhav(np.asarray(lat1) + lat2)) * dhav(dlong)
+    return np.degrees(2.0 * np.arcsin(np.sqrt(th)))
+
+
+def place_points(con):
+    # (place_key, lat, long) of every ZCTA and gazetteer place, deduplicated
+    # the way the server's geocoder does it: the last row of a zip and
+    # the first row of a case folded (state, name) pair win
+    points = {}
+    for zip_num, lat, long in con.execute(
+        "SELECT TRY_CAST(GEOID AS INTEGER) AS zip,INTPTLAT,INTPTLONG FROM place_zips "
+        "WHERE zip BETWEEN 0 AND 99999 AND INTPTLAT IS NOT NULL AND INTPTLONG IS NOT NULL"
+    ).fetchall():
+        points[f"zip:{zip_num}"] = (lat, long)
+    for usps, name, lat, long in con.execute(
+        "SELECT USPS,NAME,INTPTLAT,INTPTLONG FROM place_names"
+    ).fetchall():
+        key = f"place:{str(usps).casefold()}|{str(name).casefold()}"
+        if key not in points and lat is not None and long is not None:
+            points[key] = (lat, long)
+    return [(key, lat, long) for key, (lat, long) in points.items()]
+
+
+def init_place_worker(st_lat, st_long, st_key, fact_key, fact_year, fact_values):
+    place_worker_data.update(
+        st_lat=st_lat, st_long=st_long, st_key=st_key,
+        fact_key=fact_key, fact_year=fact_year, fact_values=fact_values,
+    )
+
+
+def fit_line(x, y):
+    # Least squares slope, intercept and R², None when there is no line to fit
+    n = len(x)
+    if n < 2 or np.ptp(x) == 0:
+        return None, None, None
+    x_c, y_c = x - x.mean(), y - y.mean()
+    slope = (x_c * y_c).sum() / (x_c * x_c).sum()
+    var_y = (y_c * y_c).sum()
+    r2 = (x_c * y_c).sum() ** 2 / ((x_c * x_c).sum() * var_y) if var_y > 0 else None
+    return float(slope), float(y.mean() - slope * x.mean()), None if r2 is None else float(r2)
+
+
+def place_batch_series(batch):
+    # Runs inside a worker process. For each place: the stations within
+    # place_radius_miles, then per element the yearly mean over those
+    # stations, the stations that had data by distance and the fitted trend
+    data = place_worker_data
+    d_lat = place_radius_miles / miles_per_degree * (1 + 1e-6)
+    rv = []
+    for place_key, lat, long in batch:
+        lo, hi = np.searchsorted(data["st_lat"], [lat - d_lat, lat + d_lat])
+        dist = great_arc_degrees(
+            data["st_long"][lo:hi], data["st_lat"][lo:hi], long, lat
+        ) * miles_per_degree
+        near = np.flatnonzero(dist < place_radius_miles) + lo
+        # by station_key, then by distance, like the server orders them
+        near = near[np.argsort(data["st_key"][near])]
+        near = near[np.argsort(dist[near - lo], kind="stable")]
+        near_keys = data["st_key"][near]
+        row_lo = np.searchsorted(data["fact_key"], near_keys, "left")
+        n_rows = np.searchsorted(data["fact_key"], near_keys, "right") - row_lo
+        rows = np.arange(n_rows.sum()) + np.repeat(row_lo - (np.cumsum(n_rows) - n_rows), n_rows)
+        row_station = np.repeat(np.arange(len(near)), n_rows)
+        for element, values in data["fact_values"].items():
+            has_value = ~np.isnan(values[rows])
+            e_rows = rows[has_value]
+            years, year_inds = np.unique(data["fact_year"][e_rows], return_inverse=True)
+            avgs = np.bincount(year_inds, weights=values[e_rows]) / np.bincount(year_inds)
+            used = np.unique(row_station[has_value])
+            rv.append((
+                place_key, element, lat, long,
+                years.astype(np.int16), avgs,
+                near_keys[used].astype(np.int32), dist[near[used] - lo],
+                *fit_line(years.astype(float), avgs),
+            ))
+    return rv
+
+
+def build_place_series(con, elements, workers, batch_size=256):
+    # Precomputes what /loc would return for every zip and place, so the
+    # server answers those with a primary key lookup into place_series
+    st_data = con.execute(
+        "SELECT station_key,Latitude,Longitude FROM stations "
+        "WHERE Latitude IS NOT NULL AND Longitude IS NOT NULL ORDER BY Latitude"
+    ).fetchnumpy()
+    cols = [element_col(element).lower() for element in elements]
+    facts = con.execute(
+        f"SELECT station_key,year,{','.join(cols)} FROM station_year_temp "
+        "ORDER BY station_key,year"
+    ).fetchnumpy()
+    fact_values = {
+        element: np.ma.filled(np.ma.asarray(facts[col], dtype=float), np.nan)
+        for element, col in zip(elements, cols)
+    }
+    init_args = (
+        np.asarray(st_data["Latitude"], dtype=float),
+        np.asarray(st_data["Longitude"], dtype=float),
+        np.asarray(st_data["station_key"]),
+        np.asarray(facts["station_key"]),
+        np.asarray(facts["year"]),
+        fact_values,
+    )
+
+    con.execute(
+        """
+        CREATE OR REPLACE TABLE place_series (
+            place_key VARCHAR, element VARCHAR, lat DOUBLE, long DOUBLE,
+            years SMALLINT[], avgs REAL[], station_keys INTEGER[], station_dists DOUBLE[],
+            slope DOUBLE, intercept DOUBLE, r2 DOUBLE,
+            PRIMARY KEY (place_key, element)
+        )
+        """
+    )
+    out_cols = [
+        "place_key", "element", "lat", "long", "years", "avgs",
+        "station_keys", "station_dists", "slope", "intercept", "r2",
+    ]
+    points = place_points(con)
+    n_rows = 0
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_place_worker, initargs=init_args
+    ) as pool:
+        for batch_rows in tqdm(
+            bounded_map(pool, place_batch_series, batched(points, batch_size), 2 * workers),
+            total=-(-len(points) // batch_size),
+            unit="batch",
+        ):
+            con.register("place_batch", pd.DataFrame(batch_rows, columns=out_cols))
+            con.execute("INSERT INTO place_series SELECT * FROM place_batch")
+            con.unregister("place_batch")
+            n_rows += len(batch_rows)
+    return n_rows
+
+
+def export_station_matrix(con, elements, out_dir="station_matrix"):
+    # Dense stations x years float32 matrix per element with NaN where a
+    # station has no value, row i being station_key i, plus the station
+    # coordinates. The server can memory map these instead of querying.
+    # meta.json ties them to the build_info id of this database
+    tmp_dir = Path(f"{out_dir}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    n_keys = con.execute("SELECT coalesce(max(station_key), -1) + 1 FROM stations").fetchone()[0]
+    first_year, last_year = con.execute(
+        "SELECT coalesce(min(year), 0), coalesce(max(year), -1) FROM station_year_temp"
+    ).fetchone()
+    st_data = con.execute("SELECT station_key,Latitude,Longitude FROM stations").fetchnumpy()
+    coords = np.full((n_keys, 2), np.nan)
+    coords[st_data["station_key"]] = np.column_stack([
+        np.ma.filled(np.ma.asarray(st_data[col], dtype=float), np.nan)
+        for col in ("Latitude", "Longitude")
+    ])
+    np.save(tmp_dir / "coords.npy", coords)
+    np.save(tmp_dir / "years.npy", np.arange(first_year, last_year + 1, dtype=np.int16))
+    for element in elements:
+        col = element_col(element).lower()
+        facts = con.execute(
+            f"SELECT station_key,year,{col} FROM station_year_temp WHERE {col} IS NOT NULL"
+        ).fetchnumpy()
+        matrix = np.full((n_keys, last_year - first_year + 1), np.nan, dtype=np.float32)
+        matrix[facts["station_key"], facts["year"] - first_year] = facts[col]
+        np.save(tmp_dir / f"{element}.npy", matrix)
+    build_id = con.execute("SELECT build_id FROM build_info").fetchone()[0]
+    (tmp_dir / "meta.json").write_text(
+        json.dumps({"build_id": build_id, "elements": elements, "first_year": first_year})
+    )
+    shutil.rmtree(out_dir, ignore_errors=True)
+    tmp_dir.rename(out_dir)
+
+
+def dir_dly_entries(in_dir):
+    # (station id, size, mtime, callable returning the file contents)
+    for f_l in sorted(Path(in_dir).rglob("*.dly")):
+        f_stat = f_l.stat()
+        get_bytes = partial(read_dly_bytes, str(f_l))
+        yield f_l.stem, f_stat.st_size, int(f_stat.st_mtime), get_bytes
+
+
+def tar_dly_entries(in_filename):
+    # The contents have to be read before moving on to the next member
+    with tarfile.open(in_filename, mode="r|*") as tar_fp:
+        for member in tar_fp:
+            if not (member.isfile() and member.name.endswith(".dly")):
+                continue
+            get_bytes = tar_fp.extractfile(member).read
+            yield Path(member.name).stem, member.size, int(member.mtime), get_bytes
+
+
+def load_dly_manifest(in_filename):
+    if not Path(in_filename).is_file():
+        return {}
+    m_df = pd.read_csv(in_filename, dtype={"ID": str, "Hash": str}, keep_default_na=False)
+    return {
+        s_id: (size, mtime, s_hash)
+        for s_id, size, mtime, s_hash in zip(
+            m_df["ID"], m_df["Size"].tolist(), m_df["MTime"].tolist(), m_df["Hash"]
+        )
+    }
+
+
+def save_dly_manifest(manifest, out_filename):
+    pd.DataFrame(
+        [(s_id, *m_entry) for s_id, m_entry in sorted(manifest.items())],
+        columns=["ID", "Size", "MTime", "Hash"],
+    ).to_csv(f"{out_filename}.tmp", index=False)
+    os.replace(f"{out_filename}.tmp", out_filename)
+
+
+def write_dly_manifest(dly_entries, out_filename):
+    # Reads every file again, builds record the manifest during their ingest
+    # and only need this when that ingest was done by an earlier run
+    save_dly_manifest(
+        {
+            s_id: dly_manifest_entry(size, mtime, get_bytes())
+            for s_id, size, mtime, get_bytes in dly_entries
+        },
+        out_filename,
+    )
+
+
+def changed_dly_stations(dly_entries, manifest, elements, con, batch_size=256):
+    # The month averages of new and changed stations go into the temp table
+    # changed_months every batch_size stations, so a big refresh is never
+    # held in memory at once. Returns the new manifest and the IDs of the
+    # changed and removed stations
+    con.execute(
+        """
+        CREATE OR REPLACE TEMP TABLE changed_months (
+            ID VARCHAR, Year BIGINT, Month BIGINT, Element VARCHAR, Average DOUBLE
+        )
+        """
+    )
+    pending = []
+
+    def insert_pending():
+        batch_months = pd.concat(pending, ignore_index=True)
+        con.execute("INSERT INTO changed_months SELECT * FROM batch_months")
+        pending.clear()
+
+    new_manifest = {}
+    changed = set()
+    for s_id, size, mtime, get_bytes in tqdm(dly_entries, unit="station"):
+        old_entry = manifest.get(s_id)
+        if old_entry is not None and old_entry[:2] == (size, mtime):
+            new_manifest[s_id] = old_entry
+            continue
+        buf = get_bytes()
+        new_manifest[s_id] = dly_manifest_entry(size, mtime, buf)
+        if old_entry is None or old_entry[2] != new_manifest[s_id][2]:
+            changed.add(s_id)
+            pending.append(dly_month_averages(buf, elements))
+            if len(pending) == batch_size:
+                insert_pending()
+    if pending:
+        insert_pending()
+    removed = set(manifest) - set(new_manifest)
+    return new_manifest, changed, removed
+
+
+def update_station_tables(con, changed, removed, station_csv, elements):
+    # The month averages of the changed stations are in changed_months
+    stale_ids = pd.DataFrame({"ID": sorted(changed | removed)})
+    y_sql = yearly_loc_to_temp_sql(
+        "changed_months", read_table_sql(station_csv), elements
+    )
+
+    meta_cols = ", ".join(station_meta_cols)
+    fact_cols = ", ".join(element_col(element) for element in elements)
+
+    con.execute("BEGIN TRANSACTION")
+    con.execute(f"CREATE TEMP TABLE new_rows AS {y_sql}")
+    # The state_code ENUM is fixed at the full build, so a state seen for the
+    # first time can't be stored
+    has_state_code = con.execute(
+        "SELECT count(*) FROM duckdb_types() WHERE type_name = 'state_code'"
+    ).fetchone()[0]
+    new_states = []
+    if has_state_code:
+        new_states = con.execute(
+            """
+            SELECT DISTINCT State::VARCHAR FROM new_rows WHERE State IS NOT NULL
+                AND State NOT IN (SELECT unnest(enum_range(NULL::state_code)))
+            """
+        ).fetchall()
+    if new_states:
+        con.execute("ROLLBACK")
+        raise SystemExit(
+            f"New state codes {', '.join(row[0] for row in new_states)} "
+            "don't fit the state_code type, run a full build"
+        )
+    con.execute(
+        "DELETE FROM station_year_temp WHERE station_key IN "
+        "(SELECT station_key FROM stations WHERE ID IN (SELECT ID FROM stale_ids))"
+    )
+    # Stations with no data left are dropped, the others keep their key and
+    # with it their place in Hilbert order, only their metadata is refreshed
+    con.execute(
+        "DELETE FROM stations WHERE ID IN (SELECT ID FROM stale_ids) "
+        "AND ID NOT IN (SELECT ID FROM new_rows)"
+    )
+    set_cols = ", ".join(f"{col} = n.{col}" for col in station_meta_cols[1:] + ["x", "y", "z"])
+    con.execute(
+        f"""
+        UPDATE stations SET {set_cols}
+        FROM (
+            SELECT *, {station_unit_vector_sql} FROM (SELECT DISTINCT {meta_cols} FROM new_rows)
+        ) AS n
+        WHERE stations.ID = n.ID
+        """
+    )
+    # Only new stations get fresh keys, after the current largest one, they
+    # are out of Hilbert order until the next full build
+    con.execute(
+        f"""
+        INSERT INTO stations
+        SELECT (SELECT coalesce(max(station_key), -1) FROM stations)
+            + row_number() OVER (ORDER BY ID), *, {station_unit_vector_sql}
+        FROM (SELECT DISTINCT {meta_cols} FROM new_rows)
+        WHERE ID NOT IN (SELECT ID FROM stations)
+        """
+    )
+    n_rows = con.execute(
+        f"""
+        INSERT INTO station_year_temp
+        SELECT stations.station_key, new_rows.Year, {fact_cols}
+        FROM new_rows JOIN stations ON new_rows.ID = stations.ID
+        """
+    ).fetchone()[0]
+    # The inserted rows went to the end of the table, sorting it again keeps
+    # each station's rows together for the station_key range pruning
+    con.execute(
+        "CREATE OR REPLACE TABLE station_year_temp AS "
+        "SELECT * FROM station_year_temp ORDER BY station_key, year"
+    )
+    con.execute("DROP TABLE new_rows")
+    con.execute("COMMIT")
+    # Keep the intermediate parquet in step so a later full build starts from it
+    con.execute(
+        f"COPY loc_to_temp TO 'db/loc_to_temp_db.parquet.tmp' ({parquet_copy_options})"
+    )
+    os.replace("db/loc_to_temp_db.parquet.tmp", "db/loc_to_temp_db.parquet")
+    return n_rows
+
+
+def incremental_build(args):
+    print("Downloading Updated Temperature Data from NOAA")
+    download_fresh(
+        "ftp://ftp.ncdc.noaa.gov/pub/data/ghcn/daily/ghcnd_all.tar.gz",
+        "ghcnd_all.tar.gz",
+    )
+    download_fresh(
+        "ftp://ftp.ncdc.noaa.gov/pub/data/ghcn/daily/ghcnd-stations.txt",
+        "data/ghcnd-stations.txt",
+    )
+    stations_to_csv("data/ghcnd-stations.txt", "data/station_data.csv")
+    if args.stream:
+        dly_entries = tar_dly_entries("ghcnd_all.tar.gz")
+    else:
+        # Extracted into an empty directory, files of stations dropped from
+        # the archive would otherwise stay and never count as removed
+        shutil.rmtree("ghcnd_all", ignore_errors=True)
+        with tarfile.open("ghcnd_all.tar.gz") as tar_fp:
+            tar_fp.extractall("./ghcnd_all/")
+        dly_entries = dir_dly_entries("ghcnd_all")
+
+    print("Finding Changed Stations")
+    manifest = load_dly_manifest("data/dly_manifest.csv")
+    con = build_connection(
+        args.memory_limit, args.temp_dir, "database.duckdb", args.row_group_size
+    )
+    new_manifest, changed, removed = changed_dly_stations(
+        dly_entries, manifest, args.elements, con, args.batch_size
+    )
+    print(f"{len(changed)} new or changed stations, {len(removed)} removed stations")
+
+    print("Updating Location and Temperature DB")
+    if changed or removed:
+        n_rows = update_station_tables(
+            con, changed, removed, "data/station_data.csv", args.elements
+        )
+        build_place_series(con, args.elements, args.workers or os.cpu_count())
+        build_derived_tables(con, args.elements)
+        export_station_matrix(con, args.elements)
+        print(f"Replaced the rows of those stations with {n_rows} station years")
+    con.close()
+    save_dly_manifest(new_manifest, "data/dly_manifest.csv")
+    print("All Done!")
+
+
+def create_macros(con):
+    # Great Arc Distance
+    # https://en.wikipedia.org/wiki/Great-circle_distance
+    macros = {
+        "dhav": ("th", "(sin(radians(th)/2)^2)"),
+        "dlta": ("a", "b", "abs(b-a)"),
+        "ahav": ("th", "2.0*asin(sqrt(th))"),
+        "gad": ("long1", "lat1", "long2", "lat2", "degrees(ahav(dhav(dlta(lat1,lat2)) + (1 - dhav(dlta(lat1,lat2)) - dhav(lat1+lat2))*dhav(dlta(long1,long2))))")
+    }
+    for mname, mdef in macros.items():
+        con.execute(f"DROP MACRO IF EXISTS {mname}")
+        msig = f"{mname}({','.join(mdef[:-1])})"
+        con.execute(f"CREATE MACRO {msig} AS {mdef[-1]}")
+
+
+def legacy_select_sql(con, table):
+    # table with the types the build gave it before the compact ones, the
+    # BIGINT, DOUBLE and VARCHAR columns pandas and read_csv_auto hand over
+    widen = {"SMALLINT": "BIGINT", "INTEGER": "BIGINT", "FLOAT": "DOUBLE"}
+    casts = [
+        f"{name}::{widen.get(col_type, 'VARCHAR')} AS {name}"
+        for name, col_type in con.execute(
+            f"SELECT column_name, column_type FROM (DESCRIBE {table})"
+        ).fetchall()
+        if name != "station_key" and (col_type in widen or col_type.startswith("ENUM"))
+    ]
+    return f"SELECT * REPLACE ({', '.join(casts)}) FROM {table}"
+
+
+def median_query_ms(con, sql, params_list):
+    times = []
+    for params in params_list:
+        t_start = time.perf_counter()
+        con.execute(sql, params).fetchall()
+        times.append(time.perf_counter() - t_start)
+    return float(np.median(times)) * 1000
+
+
+def storage_report(
+    db_file, row_group_size, out_dir="data/storage_report", n_lookups=200, n_near=25, seed=0
+):
+    # Copies stations and station_year_temp of db_file once with the old
+    # wide types and default Parquet ("before") and once as built ("after"),
+    # then compares their sizes and the time of the server's queries on them
+    out_dir = Path(out_dir)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    out_dir.mkdir(parents=True)
+    layouts = {"before": "FORMAT PARQUET", "after": parquet_copy_options}
+    con = ddb.connect()
+    con.execute(f"ATTACH '{db_file}' AS src (READ_ONLY)")
+    for layout, copy_options in layouts.items():
+        con.execute(
+            f"ATTACH '{out_dir / layout}.duckdb' AS {layout} (ROW_GROUP_SIZE {row_group_size})"
+        )
+        for table, order in (("stations", "station_key"), ("station_year_temp", "station_key, year")):
+            if layout == "before":
+                select = legacy_select_sql(con, f"src.{table}")
+            else:
+                select = f"SELECT * FROM src.{table}"
+            con.execute(f"CREATE TABLE {layout}.{table} AS {select} ORDER BY {order}")
+        con.execute(
+            f"""
+            COPY (
+                SELECT t.* EXCLUDE (station_key), s.* EXCLUDE (station_key, x, y, z)
+                FROM {layout}.station_year_temp AS t
+                JOIN {layout}.stations AS s ON t.station_key = s.station_key
+                ORDER BY t.station_key, t.year
+            ) TO '{out_dir / layout}.parquet' ({copy_options})
+            """
+        )
+        con.execute(f"DETACH {layout}")
+    n_stations = con.execute("SELECT count(*) FROM src.stations").fetchone()[0]
+    con.close()
+
+    # /loc reads the rows of the stations in range by key, Hilbert ordered
+    # key blocks stand in for them. /everywhere is served from global_yearly,
+    # which is this full scan of station_year_temp
+    loc_sql = """
+        SELECT station_key, year, average AS value
+        FROM station_year_temp
+        WHERE station_key BETWEEN ? AND ?
+            AND station_key IN (SELECT unnest(?::INTEGER[])) AND average IS NOT NULL
+    """
+    everywhere_sql = (
+        "SELECT year, count(average), sum(average) FROM station_year_temp GROUP BY year"
+    )
+    rng = np.random.default_rng(seed)
+    loc_params = [
+        [int(lo), int(lo) + n_near - 1, list(range(int(lo), int(lo) + n_near))]
+        for lo in rng.integers(0, max(n_stations - n_near, 1), n_lookups)
+    ]
+    n_scans = max(n_lookups // 10, 5)
+    report = {}
+    for layout in layouts:
+        parquet_file = out_dir / f"{layout}.parquet"
+        with closing(ddb.connect(str(out_dir / f"{layout}.duckdb"), read_only=True)) as l_con:
+            report[layout] = {
+                "database_mb": (out_dir / f"{layout}.duckdb").stat().st_size / 1e6,
+                "parquet_mb": parquet_file.stat().st_size / 1e6,
+                "loc_ms": median_query_ms(l_con, loc_sql, loc_params),
+                "everywhere_ms": median_query_ms(l_con, everywhere_sql, [[]] * n_scans),
+                "parquet_scan_ms": median_query_ms(
+                    l_con,
+                    "SELECT Year, count(Average), sum(Average) "
+                    f"FROM read_parquet('{parquet_file}') GROUP BY Year",
+                    [[]] * n_scans,
+                ),
+            }
+    (out_dir / "report.json").write_text(json.dumps(report, indent=2))
+
+    rows = (
+        ("stations + station_year_temp (MB)", "database_mb"),
+        ("loc_to_temp parquet (MB)", "parquet_mb"),
+        (f"/loc query, {n_near} stations (ms)", "loc_ms"),
+        ("/everywhere scan (ms)", "everywhere_ms"),
+        ("loc_to_temp parquet scan (ms)", "parquet_scan_ms"),
+    )
+    mnl = max(len(row[0]) for row in rows)
+    print(f"{'':{mnl}}  {'before':>10}  {'after':>10}  {'change':>8}")
+    for label, key in rows:
+        before, after = report["before"][key], report["after"][key]
+        print(f"{label:{mnl}}  {before:10.2f}  {after:10.2f}  {after / before - 1:+8.0%}")
+    print(f"Medians over {n_lookups} lookups and {n_scans} scans, written to {out_dir / 'report.json'}")
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build database.duckdb from NOAA GHCN-Daily and Census gazetteer data"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="?",
+        const=os.cpu_count(),
+        default=None,
+        metavar="N",
+        help="parse station files on N processes into Parquet shards under "
+        "data/ghcnd_all_parquet instead of averaging them in this process "
+        "(no N means one per CPU)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="read the .dly files straight out of ghcnd_all.tar.gz instead of "
+        "extracting it",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="fetch the latest NOAA data and only re-parse the station files that "
+        "changed since the last build (tracked in data/dly_manifest.csv), "
+        "updating their rows in the existing database.duckdb",
+    )
+    parser.add_argument(
+        "--elements",
+        type=lambda in_str: [element.strip().upper() for element in in_str.split(",")],
+        default=ghcnd_default_elements,
+        help="comma separated GHCN elements aggregated in the same pass over the "
+        "station files, TMAX is always included "
+        f"(default {','.join(ghcnd_default_elements)})",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        default=None,
+        help="DuckDB memory_limit for the aggregation and join steps, e.g. 8GB; "
+        "anything larger is spilled to --temp-dir",
+    )
+    parser.add_argument(
+        "--temp-dir",
+        default="data/duckdb_tmp",
+        help="where DuckDB spills intermediate results (default data/duckdb_tmp)",
+    )
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        default=16384,
+        help="rows per row group of the tables in database.duckdb (default 16384)",
+    )
+    parser.add_argument(
+        "--storage-report",
+        action="store_true",
+        help="compare the size and query times of the compact column types and "
+        "zstd Parquet of database.duckdb with the wider types and default Parquet "
+        "used before, written to data/storage_report/report.json",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=256,
+        help="number of station files handed to a worker at once",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    use_parquet = args.workers is not None
+    args.elements = ["TMAX"] + [element for element in args.elements if element != "TMAX"]
+
     Path("data").mkdir(exist_ok=True, parents=True)
     Path("db").mkdir(exist_ok=True, parents=True)
     Path("gazetteer_data").mkdir(exist_ok=True, parents=True)
 
+    if args.storage_report:
+        if not Path("database.duckdb").is_file():
+            raise SystemExit("--storage-report needs an existing database.duckdb")
+        storage_report("database.duckdb", args.row_group_size)
+        return
+
+    if args.incremental:
+        if not Path("database.duckdb").is_file():
+            raise SystemExit("--incremental needs an existing database.duckdb")
+        incremental_build(args)
+        return
+
     print("Downloading All Temperature Data from NOAA")
-    download_and_extract(
-        "ftp://ftp.ncdc.noaa.gov/pub/data/ghcn/daily/ghcnd_all.tar.gz",
-        "ghcnd_all.tar.gz",
-        "ghcnd_all",
-        is_zip=False,
-    )
+    if args.stream:
+        download_once(
+            "ftp://ftp.ncdc.noaa.gov/pub/data/ghcn/daily/ghcnd_all.tar.gz",
+            "ghcnd_all.tar.gz",
+        )
+    else:
+        download_and_extract(
+            "ftp://ftp.ncdc.noaa.gov/pub/data/ghcn/daily/ghcnd_all.tar.gz",
+            "ghcnd_all.tar.gz",
+            "ghcnd_all",
+            is_zip=False,
+        )
+
+    # Filled during the ingest, so every station file is only read once
+    dly_manifest = {}
 
     print("Transforming into usable Temperature DB")
-    if not data_file_exist("ghcnd_all.csv"):
-        read_files = list(Path("ghcnd_all").rglob("*.dly"))
-        shown_header = False
-        for f_l in tqdm(read_files):
-            fwf_check = pd.read_fwf(f_l, widths=ghcnd_all_fwf_widths, header=None)
-            if not shown_header:
-                fwf_check.to_csv(
-                    "data/ghcnd_all.csv",
-                    index=False,
-                    mode="a+",
-                    sep=",",
-                    encoding="utf-8-sig",
-                    header=ghcnd_all_fwf_header,
-                )
-                shown_header = True
+    if use_parquet:
+        if not Path("data/ghcnd_all_parquet").is_dir():
+            if args.stream:
+                dly_batches = tar_dly_batches("ghcnd_all.tar.gz", args.batch_size, dly_manifest)
             else:
-                fwf_check.to_csv(
-                    "data/ghcnd_all.csv",
-                    index=False,
-                    mode="a+",
-                    sep=",",
-                    encoding="utf-8-sig",
-                    header=None,
-                )
+                dly_batches = dir_dly_batches("ghcnd_all", args.batch_size, dly_manifest)
+            dly_to_parquet(dly_batches, "data/ghcnd_all_parquet", args.workers)
 
     print("Building Weather Station DB")
     if not data_file_exist("ghcnd-stations.txt"):
@@ -746,72 +1883,32 @@ def main():
         download_ftp_file(ftp_url, "data/ghcnd-stations.txt")
 
     if not data_file_exist("station_data.csv"):
-        fwf_check = pd.read_fwf(
-            "data/ghcnd-stations.txt",
-            widths=[11, 9, 10, 7, 3, 31, 4, 4, 6],
-            header=None,
-        )
-        fwf_check.to_csv(
-            "data/station_data.csv",
-            index=False,
-            mode="w",
-            sep=",",
-            encoding="utf-8-sig",
-            header=ghcnd_stations_fwf_header,
-        )
+        stations_to_csv("data/ghcnd-stations.txt", "data/station_data.csv")
 
     print("Building Monthly Average Temperature DB")
     if not data_file_exist("month_avg_data.csv"):
-        csv_line_headers = None
-        with open("data/month_avg_data.csv", "w") as wfp:
-            wfp.write("ID,Year,Month,Average\n")
-            f_size = os.path.getsize("data/ghcnd_all.csv")
-            n_lines_approx = int(np.ceil(f_size / 215.0))
-            with open("data/ghcnd_all.csv", "r") as fp:
-                for line in tqdm(fp, total=n_lines_approx):
-                    line = line.strip()
-                    line_arr = line.split(",")
-                    if csv_line_headers is None:
-                        line_arr[0] = "ID"
-                        csv_line_headers = line_arr.copy()
-                    else:
-                        line_dict = dict(zip(csv_line_headers, line_arr))
-                        if line_dict["Element"] != "TMAX":
-                            continue
-                        month_temp_num = 0
-                        month_temp_total = 0.0
-                        for k, v in line_dict.items():
-                            if "Value" in k:
-                                cur_val = float(v)
-                                if cur_val < -1000:
-                                    continue
-                                month_temp_num += 1
-                                month_temp_total += cur_val
-                        month_avg = month_temp_total / month_temp_num
-                        wfp.write(
-                            f"{line_dict['ID']},{line_dict['Year']},{line_dict['Month']},{month_avg}\n"
-                        )
+        if use_parquet:
+            parquet_month_avg_to_csv(
+                "data/ghcnd_all_parquet", "data/month_avg_data.csv", args.elements
+            )
+        else:
+            if args.stream:
+                dly_batches = tar_dly_batches("ghcnd_all.tar.gz", args.batch_size, dly_manifest)
+            else:
+                dly_batches = dir_dly_batches("ghcnd_all", args.batch_size, dly_manifest)
+            dly_month_avg_to_csv(dly_batches, "data/month_avg_data.csv", args.elements)
 
     print("Building Location and Temperature DB")
     if not data_file_exist("loc_to_temp_db.parquet", "db"):
-        m_avg_data = pd.read_csv("data/month_avg_data.csv")
-        station_data = pd.read_csv("data/station_data.csv")
-
-        y_avg_temp = (
-            m_avg_data.groupby(by=["ID", "Year"]).mean().drop(labels=["Month"], axis=1)
+        con = build_connection(args.memory_limit, args.temp_dir)
+        loc_to_temp_to_parquet(
+            "data/month_avg_data.csv",
+            "data/station_data.csv",
+            "db/loc_to_temp_db.parquet",
+            args.elements,
+            con,
         )
-        y_avg_temp["Average"] /= 10.0
-
-        both_inds = pd.DataFrame()
-        both_inds["ID"] = y_avg_temp.index.get_level_values(0)
-        both_inds["Year"] = y_avg_temp.index.get_level_values(1)
-
-        s_data_w_year = pd.merge(station_data, both_inds, how="left", on=["ID"])
-        s_data_w_year.set_index(["ID", "Year"], inplace=True)
-
-        all_data = y_avg_temp.merge(s_data_w_year, how="left", on=["ID", "Year"])
-        # all_data["F_Average"] = (all_data["Average"]*9/5) + 32
-        all_data.to_parquet("db/loc_to_temp_db.parquet", index=True)
+        con.close()
 
     print("Downloading and Parsing Gazetteer data")
     gazetteer_to_parquet("2021_Gaz_place_national", False)
@@ -821,9 +1918,14 @@ def main():
     print("Building Final DB")
     db_path = Path("database.duckdb")
     db_path.unlink(missing_ok=True)
-    con = ddb.connect(database="database.duckdb")
-    con.execute(
-        "CREATE TABLE loc_to_temp AS SELECT * FROM read_parquet('db/loc_to_temp_db.parquet')"
+    con = build_connection(
+        args.memory_limit, args.temp_dir, "database.duckdb", args.row_group_size
+    )
+    create_station_tables(
+        con,
+        read_table_sql("db/loc_to_temp_db.parquet"),
+        args.elements,
+        read_table_sql("data/station_data.csv"),
     )
     con.execute(
         "CREATE TABLE place_names AS SELECT * FROM read_parquet('db/2021_Gaz_place_national.parquet')"
@@ -831,25 +1933,39 @@ def main():
     con.execute(
         "CREATE TABLE place_zips AS SELECT * FROM read_parquet('db/2021_Gaz_zcta_national.parquet')"
     )
+
+    print("Precomputing Zip and Place Series")
+    build_place_series(con, args.elements, args.workers or os.cpu_count())
+
+    print("Building Precomputed Aggregates")
+    build_derived_tables(con, args.elements)
+
+    print("Exporting Station Matrices")
+    export_station_matrix(con, args.elements)
     
     print("Adding Macros")
-    # Great Arc Distance
-    # https://en.wikipedia.org/wiki/Great-circle_distance
-    macros = {
-        "dhav": ("th", "(sin(radians(th)/2)^2)"),
-        "dlta": ("a", "b", "abs(b-a)"),
-        "ahav": ("th", "2.0*asin(sqrt(th))"),
-        "gad": ("long1", "lat1", "long2", "lat2", "degrees(ahav(dhav(dlta(lat1,lat2)) + (1 - dhav(dlta(lat1,lat2)) - dhav(lat1+lat2))*dhav(dlta(long1,long2))))")
-    }
-    for mname, mdef in macros.items():
-        con.execute(f"DROP MACRO IF EXISTS {mname}")
-        msig = f"{mname}({','.join(mdef[:-1])})"
-        con.execute(f"CREATE MACRO {msig} AS {mdef[-1]}")
-    
+    create_macros(con)
+    con.close()
+
+    print("Recording Station File Manifest")
+    if dly_manifest:
+        save_dly_manifest(dly_manifest, "data/dly_manifest.csv")
+    elif args.stream:
+        # The ingest was done by an earlier run
+        write_dly_manifest(tar_dly_entries("ghcnd_all.tar.gz"), "data/dly_manifest.csv")
+    else:
+        write_dly_manifest(dir_dly_entries("ghcnd_all"), "data/dly_manifest.csv")
+
     print("All Done!")
 
     db_explain = (
-        ("loc_to_temp", "Connects locations to a time series of yearly average temperatures"),
+        ("stations", "Location and metadata of every weather station, keyed by station_key"),
+        ("station_year_temp", "Yearly averages per element of every station_key"),
+        ("loc_to_temp", "View joining the two into a time series per location"),
+        ("global_yearly", "Yearly sums and counts over every station, per element"),
+        ("grid_yearly", "Yearly sums and counts per grid cell, at several cell sizes"),
+        ("place_series", "Yearly series, stations and trend of every zip and place, per element"),
+        ("build_info", "Id and time of the build that produced this database"),
         ("place_names", "Connects names of places to latitude & longitude"),
         ("place_zips", "Connects zip codes to latitude & longitude"),
     )
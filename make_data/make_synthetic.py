@@ -0,0 +1,352 @@
+"""Writes a synthetic GHCN-Daily and Census gazetteer data set.
+
+The files have the layout of the NOAA and Census downloads and are put where
+make_data.py looks for them (ghcnd_all.tar.gz, data/ghcnd-stations.txt and
+the gazetteer zips in gazetteer_data), so running make_data.py in the output
+directory builds a database without any network access. Stations are grouped
+around towns, mostly in the US, and their daily values follow the latitude,
+elevation and season with a small warming trend, gaps and precipitation only
+stations like the real archive. The same arguments always give the same bytes.
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from make_data import batched, bounded_map
+
+# USPS code, FIPS code and rough centre of every state
+us_states = [
+    ("AL", 1, 32.8, -86.8), ("AK", 2, 61.4, -152.3), ("AZ", 4, 34.2, -111.7),
+    ("AR", 5, 34.9, -92.4), ("CA", 6, 37.2, -119.5), ("CO", 8, 39.0, -105.5),
+    ("CT", 9, 41.6, -72.7), ("DE", 10, 39.0, -75.5), ("DC", 11, 38.9, -77.0),
+    ("FL", 12, 28.6, -82.4), ("GA", 13, 32.7, -83.4), ("HI", 15, 20.8, -156.3),
+    ("ID", 16, 44.4, -114.6), ("IL", 17, 40.0, -89.2), ("IN", 18, 39.9, -86.3),
+    ("IA", 19, 42.1, -93.5), ("KS", 20, 38.5, -98.4), ("KY", 21, 37.5, -85.3),
+    ("LA", 22, 31.1, -92.0), ("ME", 23, 45.4, -69.2), ("MD", 24, 39.0, -76.8),
+    ("MA", 25, 42.3, -71.8), ("MI", 26, 44.3, -85.4), ("MN", 27, 46.3, -94.3),
+    ("MS", 28, 32.7, -89.7), ("MO", 29, 38.4, -92.5), ("MT", 30, 47.0, -109.6),
+    ("NE", 31, 41.5, -99.8), ("NV", 32, 39.3, -116.6), ("NH", 33, 43.7, -71.6),
+    ("NJ", 34, 40.2, -74.7), ("NM", 35, 34.4, -106.1), ("NY", 36, 42.9, -75.5),
+    ("NC", 37, 35.6, -79.4), ("ND", 38, 47.5, -100.5), ("OH", 39, 40.3, -82.8),
+    ("OK", 40, 35.6, -97.5), ("OR", 41, 43.9, -120.6), ("PA", 42, 40.9, -77.8),
+    ("RI", 44, 41.7, -71.5), ("SC", 45, 33.9, -80.9), ("SD", 46, 44.4, -100.2),
+    ("TN", 47, 35.9, -86.4), ("TX", 48, 31.5, -99.3), ("UT", 49, 39.3, -111.7),
+    ("VT", 50, 44.1, -72.7), ("VA", 51, 37.5, -78.9), ("WA", 53, 47.4, -120.5),
+    ("WV", 54, 38.6, -80.6), ("WI", 55, 44.6, -89.9), ("WY", 56, 43.0, -107.6),
+]
+
+# FIPS country code and (lat min, lat max, long min, long max) of the other
+# countries stations are put in
+other_countries = [
+    ("CA", 48.0, 60.0, -125.0, -65.0), ("MX", 17.0, 31.0, -110.0, -90.0),
+    ("GM", 47.5, 54.5, 6.0, 14.5), ("UK", 50.5, 57.5, -5.0, 1.5),
+    ("AS", -37.0, -15.0, 115.0, 152.0), ("IN", 9.0, 30.0, 72.0, 87.0),
+    ("BR", -28.0, -5.0, -58.0, -36.0), ("JA", 32.0, 43.0, 131.0, 141.0),
+    ("SF", -33.5, -24.0, 19.0, 31.0), ("RS", 46.0, 65.0, 32.0, 130.0),
+    ("CH", 22.0, 45.0, 100.0, 122.0), ("AR", -45.0, -24.0, -68.0, -58.0),
+]
+us_share = 0.6
+
+name_starts = ["Oak", "Spring", "Cedar", "Maple", "River", "Lake", "Fair", "Green", "Mill",
+               "Clear", "Stone", "Pine", "Elm", "Ash", "Red", "White", "Brook", "Glen"]
+name_ends = ["field", "ville", "ton", "wood", "dale", "port", "burg", "view", "haven", "ford",
+             "side", "mont", "land", "crest"]
+name_prefixes = ["", "", "", "", "North ", "East ", "West ", "South ", "Port ", "Fort ", "Mount "]
+# LSAD code of each kind of place, the kind ends the place name
+place_kinds = [("city", "25"), ("town", "43"), ("village", "47"), ("CDP", "57")]
+
+# Days in each month, values past the end of a month are missing like in the archive
+month_days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+dly_line_len = 269
+
+
+def right_aligned_ints(values, width, fill=" "):
+    # (..., width) uint8 text of ints, right aligned in fill like the fixed
+    # width fields of .dly and ghcnd-stations.txt files
+    magnitude = np.abs(values)
+    n_digits = 1 + sum((magnitude >= 10**k).astype(int) for k in range(1, width))
+    out = np.full(np.shape(values) + (width,), ord(fill), dtype=np.uint8)
+    rest = magnitude.copy()
+    for pos in range(width - 1, -1, -1):
+        out[..., pos] = np.where(width - pos <= n_digits, ord("0") + rest % 10, out[..., pos])
+        rest //= 10
+    neg = np.nonzero(values < 0)
+    out[neg + (width - 1 - n_digits[neg],)] = ord("-")
+    return out
+
+
+def station_layout(n_stations, seed):
+    # Metadata of every station and the towns they cluster around
+    rng = np.random.default_rng([seed, 0])
+    n_towns = max(10, n_stations // 40)
+    town_us = rng.random(n_towns) < us_share
+    town_us[0] = True
+    town_state = rng.integers(0, len(us_states), n_towns)
+    town_country = rng.integers(0, len(other_countries), n_towns)
+    town_lat = np.empty(n_towns)
+    town_long = np.empty(n_towns)
+    for ii in range(n_towns):
+        if town_us[ii]:
+            _, _, s_lat, s_long = us_states[town_state[ii]]
+            town_lat[ii] = s_lat + rng.normal(0, 1.2)
+            town_long[ii] = s_long + rng.normal(0, 1.8)
+        else:
+            _, lat_lo, lat_hi, long_lo, long_hi = other_countries[town_country[ii]]
+            town_lat[ii] = rng.uniform(lat_lo, lat_hi)
+            town_long[ii] = rng.uniform(long_lo, long_hi)
+
+    st_town = rng.integers(0, n_towns, n_stations)
+    lat = np.clip(town_lat[st_town] + rng.normal(0, 0.4, n_stations), -89.9, 89.9)
+    long = (town_long[st_town] + rng.normal(0, 0.5, n_stations) + 180) % 360 - 180
+    stations = []
+    for ii in range(n_stations):
+        is_us = town_us[st_town[ii]]
+        if is_us:
+            s_id = f"USC00{ii:06d}"
+            state = us_states[town_state[st_town[ii]]][0]
+        else:
+            s_id = f"{other_countries[town_country[st_town[ii]]][0]}0{ii:08d}"
+            state = ""
+        stations.append({
+            "ID": s_id,
+            "lat": round(float(lat[ii]), 4),
+            "long": round(float(long[ii]), 4),
+            "elev": round(float(rng.gamma(2.0, 250.0)), 1),
+            "state": state,
+            "name": f"SYNTHETIC {s_id[:2]} {ii}",
+            "gsn": "GSN" if rng.random() < 0.02 else "",
+            "hcn": "HCN" if is_us and rng.random() < 0.1 else "",
+            "wmo": f"{rng.integers(10000, 100000)}" if rng.random() < 0.05 else "",
+        })
+    towns = {"us": town_us, "state": town_state, "lat": town_lat, "long": town_long}
+    return stations, towns
+
+
+def stations_txt(stations):
+    # Same columns as ghcnd-stations.txt
+    return "".join(
+        f"{st['ID']:11s} {st['lat']:8.4f} {st['long']:9.4f} {st['elev']:6.1f} {st['state']:2s} "
+        f"{st['name']:30s} {st['gsn']:3s} {st['hcn']:3s} {st['wmo']:5s}\n"
+        for st in stations
+    )
+
+
+def station_values(rng, st, years):
+    # Daily values in the units of the archive, (element, year, month, day)
+    # with -9999 where missing
+    shape = (len(years), 12, 31)
+    day_of_year = np.cumsum(np.concatenate(([0], month_days[:-1])))[:, None] + np.arange(31)
+    season = np.cos(2 * np.pi * (day_of_year - 200) / 365.25) * (1 if st["lat"] >= 0 else -1)
+    mean_tmax = 31 - 0.45 * max(abs(st["lat"]) - 12, 0) - 6.5 * st["elev"] / 1000
+    warming = rng.normal(0.02, 0.01) * (years - 1950)[:, None, None]
+    tmax = (mean_tmax + (2 + 0.35 * abs(st["lat"])) * season + warming
+            + rng.normal(0, 3.5, shape))
+    tmin = tmax - rng.uniform(7, 14) - np.abs(rng.normal(0, 1.5, shape))
+    prcp = np.where(rng.random(shape) < 0.3, rng.exponential(6.0, shape), 0.0)
+
+    values = {"PRCP": np.round(prcp * 10)}
+    if rng.random() < 0.4:
+        # Less than half the stations measure temperature, the rest only precipitation
+        values["TMAX"] = np.round(tmax * 10)
+        values["TMIN"] = np.round(tmin * 10)
+        if rng.random() < 0.25:
+            values["TAVG"] = np.round((tmax + tmin) * 5)
+    if rng.random() < 0.5:
+        values["SNOW"] = np.where(tmax < 1, np.round(prcp * 10), 0)
+
+    missing = (np.arange(31) >= month_days[:, None]) | (rng.random(shape) < 0.03)
+    missing |= rng.random((len(years), 12, 1)) < 0.02
+    elements = sorted(values)
+    out = np.stack([np.where(missing, -9999, values[element]) for element in elements])
+    return elements, np.clip(out, -9999, 99999).astype(np.int64)
+
+
+def station_dly(seed, ii, st, first_year, last_year):
+    # Text of one station's .dly file, one line per year, month and element
+    rng = np.random.default_rng([seed, 1, ii])
+    n_years = last_year - first_year + 1
+    span = int(rng.integers(min(5, n_years), n_years + 1))
+    end_year = last_year if rng.random() < 0.7 else int(rng.integers(first_year + span - 1, last_year + 1))
+    years = np.arange(end_year - span + 1, end_year + 1)
+    elements, values = station_values(rng, st, years)
+
+    # Lines ordered by year, month then element
+    values = values.transpose(1, 2, 0, 3).reshape(-1, 31)
+    n_lines = len(values)
+    lines = np.full((n_lines, dly_line_len + 1), ord(" "), dtype=np.uint8)
+    lines[:, 0:11] = np.frombuffer(st["ID"].encode(), dtype=np.uint8)
+    lines[:, 11:15] = right_aligned_ints(np.repeat(years, 12 * len(elements)), 4)
+    months = np.tile(np.repeat(np.arange(1, 13), len(elements)), len(years))
+    lines[:, 15:17] = right_aligned_ints(months, 2, fill="0")
+    element_bytes = np.frombuffer("".join(elements).encode(), dtype=np.uint8).reshape(-1, 4)
+    lines[:, 17:21] = np.tile(element_bytes, (len(years) * 12, 1))
+    # Every day is VALUE (5) MFLAG QFLAG SFLAG, missing days have no flags
+    days = np.full((n_lines, 31, 8), ord(" "), dtype=np.uint8)
+    days[:, :, :5] = right_aligned_ints(values, 5)
+    days[:, :, 7] = np.where(values == -9999, ord(" "), ord("7" if st["state"] else "E"))
+    lines[:, 21:dly_line_len] = days.reshape(n_lines, -1)
+    lines[:, dly_line_len] = ord("\n")
+    return lines.tobytes()
+
+
+def station_batch_dly(batch_args):
+    # Runs inside a worker process
+    seed, first_year, last_year, batch = batch_args
+    return [
+        (st["ID"], station_dly(seed, ii, st, first_year, last_year)) for ii, st in batch
+    ]
+
+
+def write_dly_tar(stations, out_filename, seed, first_year, last_year, workers, batch_size):
+    # mtime 0 in the gzip header and in every member keeps the archive
+    # byte for byte the same between runs. Level 6 is gzip's default and
+    # about ten times faster than 9 on .dly text
+    jobs = (
+        (seed, first_year, last_year, batch)
+        for batch in batched(list(enumerate(stations)), batch_size)
+    )
+    n_bytes = 0
+    with open(f"{out_filename}.tmp", "wb") as raw_fp, \
+            gzip.GzipFile(fileobj=raw_fp, mode="wb", compresslevel=6, mtime=0) as gz_fp, \
+            tarfile.open(fileobj=gz_fp, mode="w", format=tarfile.PAX_FORMAT) as tar_fp, \
+            ProcessPoolExecutor(max_workers=workers) as pool:
+        for results in tqdm(
+            bounded_map(pool, station_batch_dly, jobs, 2 * workers), unit="batch"
+        ):
+            for s_id, dly in results:
+                info = tarfile.TarInfo(f"ghcnd_all/{s_id}.dly")
+                info.size = len(dly)
+                info.mode = 0o644
+                tar_fp.addfile(info, io.BytesIO(dly))
+                n_bytes += len(dly)
+    os.replace(f"{out_filename}.tmp", out_filename)
+    return n_bytes
+
+
+def place_name(rng):
+    return (name_prefixes[rng.integers(len(name_prefixes))]
+            + name_starts[rng.integers(len(name_starts))]
+            + name_ends[rng.integers(len(name_ends))])
+
+
+def gazetteer_texts(n_stations, towns, seed):
+    # 2021 Census gazetteer place and zip code files, around the US towns
+    rng = np.random.default_rng([seed, 2])
+    us_towns = np.flatnonzero(towns["us"])
+
+    n_places = max(100, n_stations // 4)
+    p_town = us_towns[rng.integers(0, len(us_towns), n_places)]
+    p_lat = towns["lat"][p_town] + rng.normal(0, 0.3, n_places)
+    p_long = towns["long"][p_town] + rng.normal(0, 0.4, n_places)
+    places = ["USPS\tGEOID\tANSICODE\tNAME\tLSAD\tFUNCSTAT\tALAND\tAWATER\tALAND_SQMI\tAWATER_SQMI\tINTPTLAT\tINTPTLONG\n"]
+    for ii in range(n_places):
+        usps, fips, _, _ = us_states[towns["state"][p_town[ii]]]
+        kind, lsad = place_kinds[rng.integers(len(place_kinds))]
+        a_land, a_water = int(rng.gamma(1.5, 2e7)), int(rng.gamma(0.5, 1e6))
+        places.append(
+            f"{usps}\t{fips:02d}{ii:05d}\t{2400000 + ii:08d}\t{place_name(rng)} {kind}\t{lsad}\t"
+            f"{'A' if kind != 'CDP' else 'S'}\t{a_land}\t{a_water}\t{a_land / 2589988.11:.3f}\t"
+            f"{a_water / 2589988.11:.3f}\t{p_lat[ii]:.6f}\t{p_long[ii]:.6f}\n"
+        )
+
+    n_zips = min(max(100, n_stations // 3), 99000)
+    zips = np.sort(rng.choice(np.arange(501, 99951), n_zips, replace=False))
+    z_town = us_towns[rng.integers(0, len(us_towns), n_zips)]
+    z_lat = towns["lat"][z_town] + rng.normal(0, 0.3, n_zips)
+    z_long = towns["long"][z_town] + rng.normal(0, 0.4, n_zips)
+    zctas = ["GEOID\tALAND\tAWATER\tALAND_SQMI\tAWATER_SQMI\tINTPTLAT\tINTPTLONG\n"]
+    for ii in range(n_zips):
+        a_land, a_water = int(rng.gamma(1.5, 3e7)), int(rng.gamma(0.5, 1e6))
+        zctas.append(
+            f"{zips[ii]:05d}\t{a_land}\t{a_water}\t{a_land / 2589988.11:.3f}\t"
+            f"{a_water / 2589988.11:.3f}\t{z_lat[ii]:.6f}\t{z_long[ii]:.6f}\n"
+        )
+    return "".join(places), "".join(zctas), n_places, n_zips
+
+
+def write_gazetteer_zip(in_filename, text):
+    # Fixed member date, so the zip is the same between runs
+    info = zipfile.ZipInfo(f"{in_filename}.txt", date_time=(2021, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(f"gazetteer_data/{in_filename}.zip", "w") as zip_fp:
+        zip_fp.writestr(info, text)
+
+
+def make_synthetic(n_stations, first_year, last_year, seed, workers, batch_size):
+    Path("data").mkdir(exist_ok=True, parents=True)
+    Path("gazetteer_data").mkdir(exist_ok=True, parents=True)
+
+    print("Laying Out Stations")
+    stations, towns = station_layout(n_stations, seed)
+    Path("data/ghcnd-stations.txt").write_text(stations_txt(stations))
+
+    print("Writing Station Files")
+    n_bytes = write_dly_tar(
+        stations, "ghcnd_all.tar.gz", seed, first_year, last_year, workers, batch_size
+    )
+
+    print("Writing Gazetteer Files")
+    places, zctas, n_places, n_zips = gazetteer_texts(n_stations, towns, seed)
+    write_gazetteer_zip("2021_Gaz_place_national", places)
+    write_gazetteer_zip("2021_Gaz_zcta_national", zctas)
+
+    info = {
+        "stations": n_stations,
+        "first_year": first_year,
+        "last_year": last_year,
+        "seed": seed,
+        "dly_bytes": n_bytes,
+        "places": n_places,
+        "zips": n_zips,
+    }
+    Path("synthetic.json").write_text(json.dumps(info, indent=2))
+    return info
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Write synthetic GHCN-Daily and gazetteer input files for make_data.py"
+    )
+    parser.add_argument("--stations", type=int, default=1000,
+                        help="number of stations, up to 999999 (default 1000)")
+    parser.add_argument("--first-year", type=int, default=1950,
+                        help="earliest year a station can have data for (default 1950)")
+    parser.add_argument("--last-year", type=int, default=2023,
+                        help="latest year with data (default 2023)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="the same seed and arguments always give the same files")
+    parser.add_argument("--out-dir", default=".",
+                        help="directory to run make_data.py in afterwards (default .)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="processes writing station files (default one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="number of station files handed to a worker at once")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not 1 <= args.stations <= 999999:
+        raise SystemExit("--stations has to be between 1 and 999999")
+    if args.first_year > args.last_year:
+        raise SystemExit("--first-year is after --last-year")
+    Path(args.out_dir).mkdir(exist_ok=True, parents=True)
+    os.chdir(args.out_dir)
+    info = make_synthetic(
+        args.stations, args.first_year, args.last_year, args.seed, args.workers, args.batch_size
+    )
+    print(f"{info['stations']} stations ({info['dly_bytes'] / 1e6:.1f}MB of .dly), "
+          f"{info['places']} places and {info['zips']} zips in {Path.cwd()}")
+
+
+if __name__ == '__main__':
+    main()
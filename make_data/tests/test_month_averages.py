@@ -0,0 +1,71 @@
+"""Month averages of a small fixture station against hand computed values.
+
+fixtures/USC00099999.dly has a partly missing month, a month of TMAX with
+every day missing (which crashed the old per row loop), a day below -1000
+that isn't -9999, quality flags and a SNOW line that isn't requested.
+fixtures/month_avg_data.csv holds hand computed values for it. The old loop
+only averaged TMAX, its rows are checked against old_loop_tmax below.
+"""
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import make_data as md  # noqa: E402
+
+fixture_dir = Path(__file__).resolve().parent / "fixtures"
+fixture_dly = fixture_dir / "USC00099999.dly"
+expected_csv = fixture_dir / "month_avg_data.csv"
+
+
+def old_loop_tmax(dly_path):
+    # The per row loop that wrote month_avg_data.csv before the NumPy decoder,
+    # reading the .dly instead of ghcnd_all.csv. It raised ZeroDivisionError
+    # on a month without values, this one leaves the month out
+    rows = []
+    for line in Path(dly_path).read_text().splitlines():
+        if line[17:21] != "TMAX":
+            continue
+        month_temp_num = 0
+        month_temp_total = 0.0
+        for day in range(31):
+            cur_val = float(line[21 + 8 * day:26 + 8 * day])
+            if cur_val < -1000:
+                continue
+            month_temp_num += 1
+            month_temp_total += cur_val
+        if month_temp_num == 0:
+            continue
+        rows.append((line[0:11], int(line[11:15]), int(line[15:17]), month_temp_total / month_temp_num))
+    return pd.DataFrame(rows, columns=["ID", "Year", "Month", "Average"])
+
+
+def test_tmax_matches_old_loop():
+    want = pd.read_csv(expected_csv)
+    want = want[want["Element"] == "TMAX"].drop(columns="Element").reset_index(drop=True)
+    pd.testing.assert_frame_equal(old_loop_tmax(fixture_dly), want)
+
+
+def test_dly_month_avg_to_csv(tmp_path):
+    out_csv = tmp_path / "month_avg_data.csv"
+    md.dly_month_avg_to_csv([[str(fixture_dly)]], out_csv, md.ghcnd_default_elements)
+    assert out_csv.read_text() == expected_csv.read_text()
+
+
+def test_archive_bytes_match_files():
+    # --stream hands the decoder the bytes read out of the archive
+    from_file = md.dly_batch_month_averages([str(fixture_dly)], md.ghcnd_default_elements)
+    from_bytes = md.dly_batch_month_averages([fixture_dly.read_bytes()], md.ghcnd_default_elements)
+    pd.testing.assert_frame_equal(from_file, from_bytes)
+
+
+def test_parquet_ingest_matches(tmp_path):
+    # The --workers path goes through Parquet shards and DuckDB instead
+    md.dly_batch_to_parquet((0, [str(fixture_dly)], str(tmp_path / "shards")))
+    out_csv = tmp_path / "month_avg_data.csv"
+    md.parquet_month_avg_to_csv(tmp_path / "shards", out_csv, md.ghcnd_default_elements)
+    keys = ["ID", "Year", "Month", "Element"]
+    got = pd.read_csv(out_csv).sort_values(keys, ignore_index=True)
+    want = pd.read_csv(expected_csv).sort_values(keys, ignore_index=True)
+    pd.testing.assert_frame_equal(got, want)
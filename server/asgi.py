@@ -0,0 +1,170 @@
+"""Async entry point for server.py, e.g. ``uvicorn asgi:app`` from this directory.
+
+Connections are handled on the event loop, so idle or slow clients cost
+almost nothing. The Flask views (and the DuckDB queries they make) run on
+a bounded thread pool through run_in_executor. Once GW_ASYNC_WORKERS
+requests are running and GW_ASYNC_QUEUE_SIZE more are waiting, new
+requests are turned away with a 503 instead of piling up. The check is made
+before the request body is read, and bodies over GW_ASYNC_MAX_BODY_SIZE
+bytes get a 413, so a flood of large POSTs is never buffered.
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import server
+
+server.app.config.setdefault("ASYNC_WORKERS", server.app.config["DB_POOL_SIZE"])
+server.app.config.setdefault("ASYNC_QUEUE_SIZE", 64)
+server.app.config.setdefault("ASYNC_MAX_BODY_SIZE", 1024 * 1024)
+
+db_executor = ThreadPoolExecutor(
+    max_workers=server.app.config["ASYNC_WORKERS"],
+    thread_name_prefix="gw-db",
+)
+max_in_flight = server.app.config["ASYNC_WORKERS"] + server.app.config["ASYNC_QUEUE_SIZE"]
+max_body_size = server.app.config["ASYNC_MAX_BODY_SIZE"]
+n_in_flight = 0
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def declared_length(scope):
+    for name, value in scope["headers"]:
+        if name == b"content-length":
+            return int(value)
+    return None
+
+
+async def read_body(scope, receive):
+    # Refuses a body over max_body_size from its Content-Length, or once
+    # that many bytes came in when the length isn't declared
+    length = declared_length(scope)
+    if length is not None and length > max_body_size:
+        raise BodyTooLarge
+    chunks = []
+    n_read = 0
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunk = message.get("body", b"")
+        n_read += len(chunk)
+        if n_read > max_body_size:
+            raise BodyTooLarge
+        chunks.append(chunk)
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin1")
+        value = value.decode("latin1")
+        if name == "content-length":
+            continue
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+            continue
+        key = "HTTP_" + name.upper().replace("-", "_")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_flask(environ):
+    # Runs on a db_executor thread
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    app_iter = server.app(environ, start_response)
+    try:
+        body = b"".join(app_iter)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+    status, headers = started
+    return int(status.split(" ", 1)[0]), headers, body
+
+
+async def send_response(send, status, headers, body):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            db_executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    global n_in_flight
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if n_in_flight >= max_in_flight:
+        await send_response(
+            send, 503,
+            [("Content-Type", "text/plain"), ("Retry-After", "1")],
+            b"Server busy, try again shortly",
+        )
+        return
+
+    # The slot is taken while the body comes in, so bodies being read count
+    # against the limit too
+    n_in_flight += 1
+    try:
+        try:
+            body = await read_body(scope, receive)
+        except ValueError:
+            status, headers, resp_body = 400, [("Content-Type", "text/plain")], b"Invalid Content-Length"
+        except BodyTooLarge:
+            status, headers, resp_body = 413, [("Content-Type", "text/plain")], b"Request body too large"
+        else:
+            status, headers, resp_body = await asyncio.get_running_loop().run_in_executor(
+                db_executor, call_flask, wsgi_environ(scope, body)
+            )
+    finally:
+        n_in_flight -= 1
+    await send_response(send, status, headers, resp_body)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host='127.0.0.1', port=10420)
@@ -0,0 +1,62 @@
+"""Copies the static assets server.py links to into static/dist.
+
+Each asset gets a content hashed filename plus gzip and, when the brotli
+module is installed, brotli compressed variants next to it. The mapping
+from the original to the hashed name is written to static/dist/manifest.json.
+Run it from the server directory after `npm install`, server.py picks the
+manifest up on start.
+"""
+import gzip
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+static_dir = Path("./static")
+dist_dir = static_dir / "dist"
+
+assets = [
+    "node_modules/plotly.js-dist-min/plotly.min.js",
+]
+
+
+def hashed_name(in_path, n_chars=12):
+    digest = hashlib.sha256(in_path.read_bytes()).hexdigest()[:n_chars]
+    return f"{in_path.stem}.{digest}{in_path.suffix}"
+
+
+def build_asset(name):
+    src = static_dir / name
+    out = dist_dir / hashed_name(src)
+    shutil.copyfile(src, out)
+    data = out.read_bytes()
+    # mtime=0 keeps the .gz byte for byte the same between builds
+    Path(f"{out}.gz").write_bytes(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        Path(f"{out}.br").write_bytes(brotli.compress(data, quality=11))
+    return out.name
+
+
+def build_assets(names=assets):
+    dist_dir.mkdir(parents=True, exist_ok=True)
+    for old_file in dist_dir.iterdir():
+        old_file.unlink()
+    manifest = {name: build_asset(name) for name in names}
+    (dist_dir / "manifest.json").write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+if __name__ == '__main__':
+    if brotli is None:
+        print("brotli is not installed, only writing .gz variants")
+    for name, hashed in build_assets().items():
+        sizes = [
+            (dist_dir / f"{hashed}{ext}").stat().st_size
+            for ext in ("", ".gz", ".br") if (dist_dir / f"{hashed}{ext}").exists()
+        ]
+        print(name, "->", hashed, " ".join(f"{size / 1e6:.2f}MB" for size in sizes))
@@ -0,0 +1,87 @@
+"""Startup budget for server.py.
+
+Imports server.py in fresh interpreters, the way a new worker starts, and
+records how long the import took and the peak RSS afterwards. Exits with 1
+when the median import time or the RSS is over budget, or when one of the
+lazily imported modules was loaded at startup. Run it from the server
+directory next to database.duckdb.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Not needed to start serving, importing them at startup is a regression
+lazy_modules = ["pandas", "pyarrow", "seaborn", "statsmodels"]
+
+child_code = f"""
+import json, resource, sys, time
+t_start = time.perf_counter()
+import server
+t_import = time.perf_counter() - t_start
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# ru_maxrss is in bytes on macOS and KiB everywhere else
+rss_mb = max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+print(json.dumps({{
+    "import_seconds": t_import,
+    "rss_mb": rss_mb,
+    "lazy_loaded": [m for m in {lazy_modules!r} if m in sys.modules],
+}}))
+"""
+
+
+def measure_startup(n_runs):
+    runs = []
+    for _ in range(n_runs):
+        out = subprocess.run(
+            [sys.executable, "-c", child_code], capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return {
+        "runs": n_runs,
+        "import_seconds": statistics.median(run["import_seconds"] for run in runs),
+        "rss_mb": max(run["rss_mb"] for run in runs),
+        "lazy_loaded": sorted({m for run in runs for m in run["lazy_loaded"]}),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Check the import time and RSS of server.py")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Fresh interpreters to import server.py in")
+    parser.add_argument("--max-seconds", type=float, default=2.0,
+                        help="Budget for the median import time")
+    parser.add_argument("--max-rss-mb", type=float, default=300.,
+                        help="Budget for the peak RSS after the import")
+    parser.add_argument("--out", default=None,
+                        help="Also write the measurements to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = measure_startup(args.runs)
+    result["max_seconds"] = args.max_seconds
+    result["max_rss_mb"] = args.max_rss_mb
+    print(f"import server: {result['import_seconds']:.3f}s median of {args.runs}, "
+          f"{result['rss_mb']:.1f}MB peak RSS")
+    if args.out:
+        with open(args.out, "w") as fp:
+            json.dump(result, fp, indent=2)
+
+    ok = True
+    if result["import_seconds"] > args.max_seconds:
+        print(f"Import time is over the {args.max_seconds}s budget")
+        ok = False
+    if result["rss_mb"] > args.max_rss_mb:
+        print(f"RSS is over the {args.max_rss_mb}MB budget")
+        ok = False
+    if result["lazy_loaded"]:
+        print(f"Imported at startup: {', '.join(result['lazy_loaded'])}")
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
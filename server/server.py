@@ -1,27 +1,357 @@
 import os
+import hashlib
 import html
+import importlib.util
+import itertools
 import re
 import sys
 import json
+import mimetypes
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from flask import Flask, redirect, url_for, request, render_template, send_from_directory, abort
+from flask import Flask, Response, redirect, url_for, request, render_template, send_from_directory, abort, jsonify
+from werkzeug.datastructures import MultiDict
 
 
 import duckdb as ddb
 import numpy as np
-import pandas as pd
-import seaborn as sns
-import statsmodels.api as sm
+from scipy.spatial import cKDTree
 
-con = ddb.connect(database='./database.duckdb', read_only=True)
+# pandas and pyarrow are left out of the startup path on purpose,
+# pyarrow is only imported for Arrow responses, see check_startup.py
+
+db_file = './database.duckdb'
 app = Flask(
     __name__,
     static_folder="./static",
     template_folder="./templates"
 )
+# Defaults, each can be overridden with a GW_ prefixed environment variable
+app.config.update(
+    LOC_CACHE_SIZE=1024,
+    LOC_CACHE_TTL=3600,
+    LOC_CACHE_PRECISION=3,
+    DB_POOL_SIZE=8,
+    DB_THREADS=os.cpu_count(),
+    API_MAX_AGE=3600,
+    BATCH_MAX_SIZE=1000,
+    MAX_RADIUS_MILES=500,
+    GRID_MIN_RADIUS=70,
+    LOC_BACKEND="sql",
+    MATRIX_DIR="./station_matrix",
+)
+app.config.from_prefixed_env("GW")
+
+con = ddb.connect(
+    database=db_file, read_only=True, config={"threads": app.config["DB_THREADS"]}
+)
 
 si = html.escape
 
+# GHCN element -> (menu label, y axis title, unit of the stored values, see
+# element_scale in make_data.py), elements missing here get a generic title
+element_info = {
+    "TMAX": ("Maximum Temperature", "Average Temperature", "°C"),
+    "TMIN": ("Minimum Temperature", "Average Minimum Temperature", "°C"),
+    "TAVG": ("Average Temperature", "Average Daily Mean Temperature", "°C"),
+    "PRCP": ("Precipitation", "Average Daily Precipitation", "mm"),
+    "SNOW": ("Snowfall", "Average Daily Snowfall", "mm"),
+    "SNWD": ("Snow Depth", "Average Snow Depth", "mm"),
+}
+
+
+def read_elements(in_con):
+    # The elements make_data.py --elements built, from the columns of
+    # station_year_temp: GHCN element -> (column, y axis title, is a
+    # temperature, unit, menu label)
+    rv = {}
+    for (col,) in in_con.execute(
+        "SELECT column_name FROM duckdb_columns() WHERE table_name = 'station_year_temp' "
+        "AND column_name NOT IN ('station_key', 'year') ORDER BY column_index"
+    ).fetchall():
+        # TMAX keeps its historical Average column name
+        element = "TMAX" if col == "average" else col.upper()
+        label, y_title, unit = element_info.get(element, (element, f"Average {element}", ""))
+        rv[element] = (col, y_title, unit == "°C", unit, label)
+    return rv
+
+
+elements = read_elements(con)
+element_labels = {element: elements[element][4] for element in elements}
+
+class ResultCache:
+    """Thread safe LRU cache whose entries expire after ttl seconds.
+
+    Everything is dropped as soon as the file at db_file changes, the
+    cached results were computed from the old database.
+    """
+
+    def __init__(self, max_size, ttl, db_file):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_file = db_file
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._db_stamp = self._stamp()
+
+    def _stamp(self):
+        st = os.stat(self.db_file)
+        return st.st_mtime_ns, st.st_size
+
+    def _check_db(self):
+        stamp = self._stamp()
+        if stamp != self._db_stamp:
+            self._entries.clear()
+            self._db_stamp = stamp
+
+    def get(self, key):
+        with self._lock:
+            self._check_db()
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._check_db()
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class CursorPool:
+    """Fixed set of cursors on one DuckDB connection.
+
+    A cursor is a connection of its own to the same database, so requests
+    holding different cursors run their queries in parallel and can't
+    read each other's results. cursor() blocks while all are in use.
+    """
+
+    def __init__(self, in_con, size):
+        self.size = size
+        self._free = queue.LifoQueue()
+        for _ in range(size):
+            self._free.put(in_con.cursor())
+
+    @contextmanager
+    def cursor(self):
+        cur = self._free.get()
+        try:
+            yield cur
+        finally:
+            self._free.put(cur)
+
+
+db_pool = CursorPool(con, app.config["DB_POOL_SIZE"])
+
+loc_cache = ResultCache(
+    app.config["LOC_CACHE_SIZE"], app.config["LOC_CACHE_TTL"], db_file
+)
+
+# the conversions aren't exact, but a roughly
+# 35 mile radius seems right based on NOAA queries
+radius_miles = 35.
+miles_per_degree = 69.
+
+
+def unit_vectors(lat, long):
+    lat_r = np.radians(np.asarray(lat, dtype=float))
+    long_r = np.radians(np.asarray(long, dtype=float))
+    return np.stack(
+        (np.cos(lat_r) * np.cos(long_r), np.cos(lat_r) * np.sin(long_r), np.sin(lat_r)),
+        axis=-1
+    )
+
+
+def gad(long1, lat1, long2, lat2):
+    # NumPy version of the gad macro make_data.py stores in the database
+    dhav = lambda th: np.sin(np.radians(th) / 2) ** 2
+    dlat = np.abs(np.asarray(lat2) - lat1)
+    dlong = np.abs(np.asarray(long2) - long1)
+    th = dhav(dlat) + (1 - dhav(dlat) - dhav(np.asarray(lat1) + lat2)) * dhav(dlong)
+    return np.degrees(2.0 * np.arcsin(np.sqrt(th)))
+
+
+def bounding_box(llat, llong, radius=radius_miles):
+    # Latitude/longitude box around the radius, grid_interior_cells only
+    # looks at the grid cells inside it
+    th = np.radians(radius / miles_per_degree)
+    d_lat = np.degrees(th)
+    if abs(llat) + d_lat >= 90.:
+        return llat - d_lat, llat + d_lat, -180., 180.
+    d_long = np.degrees(np.arcsin(np.sin(th) / np.cos(np.radians(llat))))
+    if abs(llong) + d_long > 180.:
+        return llat - d_lat, llat + d_lat, -180., 180.
+    return llat - d_lat, llat + d_lat, llong - d_long, llong + d_long
+
+
+def build_station_index(in_con):
+    # KD-tree over the 3-D unit vectors make_data.py stores, the straight line
+    # (chord) distance between two of them only grows with the great circle one
+    st_data = in_con.execute(
+        "SELECT station_key,ID,Name,Longitude,Latitude,x,y,z FROM stations "
+        "WHERE x IS NOT NULL ORDER BY station_key"
+    ).fetchnumpy()
+    return st_data, cKDTree(np.column_stack((st_data["x"], st_data["y"], st_data["z"])))
+
+
+station_data, station_tree = build_station_index(con)
+
+
+def near_station_pairs(llats, llongs, radius=radius_miles):
+    # Every (point, station) pair within radius of each other for many points
+    # in one pass, as arrays of point index, station_data row and distance
+    llats = np.asarray(llats, dtype=float)
+    llongs = np.asarray(llongs, dtype=float)
+    chord = 2 * np.sin(np.radians(radius / miles_per_degree) / 2)
+    # a hair wider so the exact gad cut below decides the boundary
+    s_lists = station_tree.query_ball_point(unit_vectors(llats, llongs), chord * (1 + 1e-9))
+    n_near = np.fromiter(map(len, s_lists), dtype=np.int64, count=len(s_lists))
+    pt_inds = np.repeat(np.arange(len(s_lists)), n_near)
+    s_inds = np.fromiter(itertools.chain.from_iterable(s_lists), dtype=np.int64, count=n_near.sum())
+    dist = gad(
+        station_data["Longitude"][s_inds], station_data["Latitude"][s_inds],
+        llongs[pt_inds], llats[pt_inds]
+    ) * miles_per_degree
+    in_range = dist < radius
+    return pt_inds[in_range], s_inds[in_range], dist[in_range]
+
+
+def near_stations(llat, llong, radius=radius_miles):
+    _, s_inds, dist = near_station_pairs([llat], [llong], radius)
+    by_row = np.argsort(s_inds)
+    near = {k: v[s_inds[by_row]] for k, v in station_data.items()}
+    near["Dist"] = dist[by_row]
+    return near
+
+
+def build_geocoder(in_con):
+    # Zips index straight into a 100000 x 2 array of coordinates (NaN when
+    # unknown), places are looked up by their case folded (state, name)
+    zip_data = in_con.execute(
+        "SELECT TRY_CAST(GEOID AS INTEGER) AS zip,INTPTLAT,INTPTLONG FROM place_zips "
+        "WHERE zip BETWEEN 0 AND 99999 AND INTPTLAT IS NOT NULL AND INTPTLONG IS NOT NULL"
+    ).fetchnumpy()
+    zip_coords = np.full((100000, 2), np.nan)
+    zip_coords[zip_data["zip"]] = np.column_stack((zip_data["INTPTLAT"], zip_data["INTPTLONG"]))
+    place_coords = {}
+    for usps, name, lat, long in in_con.execute(
+        "SELECT USPS,NAME,INTPTLAT,INTPTLONG FROM place_names "
+        "WHERE INTPTLAT IS NOT NULL AND INTPTLONG IS NOT NULL"
+    ).fetchall():
+        place_coords.setdefault((str(usps).casefold(), str(name).casefold()), (lat, long))
+    return zip_coords, place_coords
+
+
+zip_coords, place_coords = build_geocoder(con)
+
+
+def geocode_zip(in_zip):
+    z_num = int(in_zip)
+    if not 0 <= z_num < len(zip_coords) or np.isnan(zip_coords[z_num, 0]):
+        return None
+    return tuple(zip_coords[z_num].tolist())
+
+
+def geocode_place(in_city, in_state):
+    return place_coords.get((in_state.strip().casefold(), in_city.strip().casefold()))
+
+
+# Only changes when the database is rebuilt, so it is read once
+global_yearly = con.execute("SELECT * FROM global_yearly ORDER BY year").fetchnumpy()
+
+
+# Read once without parameters, a bound parameter makes DuckDB import
+# pandas and pyarrow at startup
+table_names = {row[0] for row in con.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+
+
+def read_build_id(in_con):
+    # Databases from before build_info fall back to the file's stamp
+    try:
+        return in_con.execute("SELECT build_id FROM build_info").fetchone()[0]
+    except ddb.CatalogException:
+        st = os.stat(db_file)
+        return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+build_id = read_build_id(con)
+
+
+def check_station_index(n_points=50, seed=0):
+    # Compares the KD-tree lookup with the gad query it replaced
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(station_data["ID"]), n_points)
+    n_bad = 0
+    for llat, llong in zip(station_data["Latitude"][picks] + rng.normal(0, .3, n_points), station_data["Longitude"][picks] + rng.normal(0, .3, n_points)):
+        with db_pool.cursor() as cur:
+            sql_ids = {row[0] for row in cur.execute(
+                "SELECT ID FROM stations WHERE gad(Longitude, Latitude, ?, ?)*69 < 35",
+                [llong, llat]
+            ).fetchall()}
+        tree_ids = set(near_stations(llat, llong)["ID"])
+        if sql_ids != tree_ids:
+            n_bad += 1
+            print(f"Mismatch at {llat}, {llong}: {sorted(sql_ids ^ tree_ids)}")
+    print(f"{n_points - n_bad}/{n_points} radius lookups match the gad query")
+    return n_bad == 0
+
+
+def check_concurrency(n_requests=200, worker_counts=(1, 2, 4, 8), seed=0, min_speedup=1.5):
+    # Runs the same uncached /loc lookups serially and from several threads,
+    # every threaded result has to match its serial one. With more than one
+    # CPU the most workers also have to reach min_speedup times the
+    # throughput of the fewest, or the lookups are serialized somewhere
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(station_data["ID"]), n_requests)
+    points = list(zip(station_data["Latitude"][picks].tolist(), station_data["Longitude"][picks].tolist()))
+    expected = [loc_series(llat, llong, "TMAX", False) for llat, llong in points]
+    all_ok = True
+    rates = {}
+    for n_workers in worker_counts:
+        t_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            got = list(pool.map(lambda pt: loc_series(*pt, "TMAX", False), points))
+        rates[n_workers] = n_requests / (time.perf_counter() - t_start)
+        n_crossed = sum(g[:2] != e[:2] for g, e in zip(got, expected))
+        all_ok = all_ok and n_crossed == 0
+        print(f"{n_workers} workers: {rates[n_workers]:.1f} requests/s, {n_crossed} mismatched results")
+    n_lo, n_hi = min(rates), max(rates)
+    if n_hi > n_lo:
+        speedup = rates[n_hi] / rates[n_lo]
+        msg = f"{speedup:.2f}x speedup from {n_lo} to {n_hi} workers"
+        if (os.cpu_count() or 1) < 2:
+            print(f"{msg}, not checked with a single CPU")
+        elif speedup < min_speedup:
+            print(f"{msg}, below the {min_speedup}x minimum")
+            all_ok = False
+        else:
+            print(msg)
+    return all_ok
+
 def render_df(in_df):
     return render_template(
         'tables.jinja2',
@@ -44,121 +374,728 @@ def is_int(in_str):
     except ValueError:
         return False
 
+def trend_sums(years, values):
+    # Running totals of the per-year sufficient statistics n, x, y, xy, xx, yy
+    # with a leading row of zeros, so any year range is a single subtraction.
+    # x counts from the first year, which keeps the squares small
+    years = np.asarray(years, dtype=np.int64)
+    y = np.asarray(values, dtype=float)
+    x = (years - years[:1]).astype(float)
+    per_year = np.column_stack((np.ones_like(y), x, y, x * y, x * x, y * y))
+    cum = np.vstack((np.zeros((1, 6)), np.cumsum(per_year, axis=0)))
+    return years, cum
+
+
+def fit_trend(sums, start_year=None, end_year=None):
+    # Least squares line over the years in [start_year, end_year], None
+    # for either end means the first or last year with data
+    years, cum = sums
+    lo = 0 if start_year is None else np.searchsorted(years, start_year, "left")
+    hi = len(years) if end_year is None else np.searchsorted(years, end_year, "right")
+    n, sx, sy, sxy, sxx, syy = cum[hi] - cum[lo] if hi > lo else np.zeros(6)
+    rv = {
+        "start_year": start_year if start_year is not None else (int(years[lo]) if hi > lo else None),
+        "end_year": end_year if end_year is not None else (int(years[hi - 1]) if hi > lo else None),
+        "n": int(n),
+        "slope": None,
+        "intercept": None,
+        "r2": None,
+        "change": None,
+    }
+    var_x = n * sxx - sx * sx
+    if n < 2 or var_x <= 0:
+        return rv
+    cov_xy = n * sxy - sx * sy
+    var_y = n * syy - sy * sy
+    slope = float(cov_xy / var_x)
+    rv["slope"] = slope
+    rv["intercept"] = float((sy - slope * sx) / n - slope * int(years[0]))
+    rv["r2"] = float(cov_xy * cov_xy / (var_x * var_y)) if var_y > 0 else None
+    rv["change"] = slope * (rv["end_year"] - rv["start_year"])
+    return rv
+
+
+def year_range(args):
+    # (start_year, end_year) query arguments, either can be left out
+    rv = []
+    for name in ("start_year", "end_year"):
+        value = si(args.get(name, default=""))
+        if value and not is_int(value):
+            raise RuntimeError(f"{name}={value}")
+        rv.append(int(value) if value else None)
+    return tuple(rv)
+
+
+def loc_series(llat, llong, element, is_far, radius=radius_miles):
+    e_col = elements[element][0]
+    t_expr = f"(({e_col} * 1.8) + 32)" if is_far else e_col
+    # The stations in range come from the in memory index,
+    # only their yearly rows are fetched by station_key. Keys follow a
+    # Hilbert curve, so the key range also lets DuckDB skip row groups
+    near = near_stations(llat, llong, radius)
+    near_keys = near["station_key"].tolist()
+    with db_pool.cursor() as cur:
+        rv_data = cur.execute(f"""
+        SELECT station_key,year,{t_expr} AS value
+        FROM station_year_temp
+        WHERE station_key BETWEEN ? AND ?
+            AND station_key IN (SELECT unnest(?::INTEGER[])) AND {e_col} IS NOT NULL
+        """, [min(near_keys, default=0), max(near_keys, default=-1), near_keys]
+        ).fetchnumpy()
+    # Yearly means over the stations, then the stations that had data by distance
+    years, year_inds = np.unique(rv_data["year"], return_inverse=True)
+    year_avg = np.bincount(year_inds, weights=rv_data["value"]) / np.bincount(year_inds)
+    rv_temp = {"Year": years.tolist(), "avg": year_avg.tolist()}
+    rv_sums = trend_sums(years, year_avg)
+    used = np.isin(near["station_key"], rv_data["station_key"])
+    by_dist = np.argsort(near["Dist"][used], kind="stable")
+    rv_stations = {
+        out_col: near[col][used][by_dist].tolist()
+        for out_col, col in (
+            ("ID", "ID"), ("name", "Name"), ("long", "Longitude"), ("lat", "Latitude"), ("dist", "Dist")
+        )
+    }
+    return rv_temp, rv_stations, rv_sums
+
+
+def batch_series(points, element, is_far, radius=radius_miles):
+    # loc_series for many (lat, long) points, with a single spatial pass and
+    # a single query. Returns (yearly series, number of stations used,
+    # trend sums) per point
+    if not len(points):
+        return []
+    e_col = elements[element][0]
+    t_expr = f"(({e_col} * 1.8) + 32)" if is_far else e_col
+    llats, llongs = np.asarray(points, dtype=float).reshape(-1, 2).T
+    pt_inds, s_inds, _ = near_station_pairs(llats, llongs, radius)
+    pair_keys = station_data["station_key"][s_inds]
+    with db_pool.cursor() as cur:
+        rv_data = cur.execute(f"""
+        SELECT station_key,year,{t_expr} AS value
+        FROM station_year_temp
+        WHERE station_key IN (SELECT unnest(?::INTEGER[])) AND {e_col} IS NOT NULL
+        ORDER BY station_key,year
+        """, [np.unique(pair_keys).tolist()]
+        ).fetchnumpy()
+    # Each (point, station) pair takes the slice of rows of its station
+    row_lo = np.searchsorted(rv_data["station_key"], pair_keys, "left")
+    n_rows = np.searchsorted(rv_data["station_key"], pair_keys, "right") - row_lo
+    row_pts = np.repeat(pt_inds, n_rows)
+    row_inds = np.arange(n_rows.sum()) + np.repeat(row_lo - (np.cumsum(n_rows) - n_rows), n_rows)
+    # then the yearly means of every point come from one bincount over (point, year) cells
+    years = np.unique(rv_data["year"])
+    cells = row_pts * len(years) + np.searchsorted(years, rv_data["year"][row_inds])
+    n_cells = len(points) * len(years)
+    cell_n = np.bincount(cells, minlength=n_cells).reshape(len(points), len(years))
+    cell_sum = np.bincount(
+        cells, weights=rv_data["value"][row_inds], minlength=n_cells
+    ).reshape(len(points), len(years))
+    n_stations = np.bincount(pt_inds, weights=n_rows > 0, minlength=len(points))
+    rv = []
+    for pt_n, pt_sum, pt_stations in zip(cell_n, cell_sum, n_stations):
+        has_data = pt_n > 0
+        pt_years, pt_avg = years[has_data], pt_sum[has_data] / pt_n[has_data]
+        rv.append((
+            {"Year": pt_years.tolist(), "avg": pt_avg.tolist()},
+            int(pt_stations),
+            trend_sums(pt_years, pt_avg),
+        ))
+    return rv
+
+
+# Must match grid_cell_degrees in make_data.py
+grid_cell_degrees = [2.0, 1.0, 0.5]
+# The grid path lists the stations in range from station_elements, both
+# come from the same build step
+use_grid = "grid_yearly" in table_names and "station_elements" in table_names
+
+
+def read_station_elements(in_con):
+    # Per element, whether each station_key has any year of it
+    n_data = in_con.execute("SELECT * FROM station_elements").fetchnumpy()
+    n_keys = int(max(n_data["station_key"].max(initial=-1), station_data["station_key"].max(initial=-1))) + 1
+    rv = {}
+    for element, (e_col, *_) in elements.items():
+        has_element = np.zeros(n_keys, dtype=bool)
+        has_element[n_data["station_key"]] = n_data[f"n_{e_col}"] > 0
+        rv[element] = has_element
+    return rv
+
+
+if use_grid:
+    station_elements = read_station_elements(con)
+
+
+def grid_cell_keys(level, lat, long):
+    # NumPy version of grid_cell_key_sql in make_data.py
+    size = grid_cell_degrees[level]
+    n_rows, n_cols = round(180 / size), round(360 / size)
+    row = np.minimum(np.floor((np.asarray(lat) + 90) / size).astype(np.int64), n_rows - 1)
+    col = np.minimum(np.floor((np.asarray(long) + 180) / size).astype(np.int64), n_cols - 1)
+    return (np.int64(level) << 32) + row * n_cols + col
+
+
+def grid_interior_cells(llat, llong, radius):
+    # cell_key of the grid cells lying entirely within radius, each at the
+    # coarsest level that does. On a lat/long cell the distance to a point
+    # peaks at one of the corners, so a cell is inside when all 4 are
+    lat_lo, lat_hi, long_lo, long_hi = bounding_box(llat, llong, radius)
+    interior = []
+    rows = cols = None
+    for level, size in enumerate(grid_cell_degrees):
+        n_rows, n_cols = round(180 / size), round(360 / size)
+        box_rows = np.arange(max(int((lat_lo + 90) // size), 0), min(int((lat_hi + 90) // size), n_rows - 1) + 1)
+        box_cols = np.arange(max(int((long_lo + 180) // size), 0), min(int((long_hi + 180) // size), n_cols - 1) + 1)
+        if rows is None:
+            rows, cols = (a.ravel() for a in np.meshgrid(box_rows, box_cols, indexing="ij"))
+        else:
+            in_box = np.isin(rows, box_rows) & np.isin(cols, box_cols)
+            rows, cols = rows[in_box], cols[in_box]
+        c_lat = np.stack((rows, rows, rows + 1, rows + 1)) * size - 90
+        c_long = np.stack((cols, cols + 1, cols, cols + 1)) * size - 180
+        inside = (gad(c_long, c_lat, llong, llat) * miles_per_degree < radius * (1 - 1e-9)).all(axis=0)
+        interior.append((np.int64(level) << 32) + rows[inside] * n_cols + cols[inside])
+        # the rest is split into its 4 children for the next level
+        rows = np.concatenate([2 * rows[~inside] + d_row for d_row in (0, 0, 1, 1)])
+        cols = np.concatenate([2 * cols[~inside] + d_col for d_col in (0, 1, 0, 1)])
+    return np.concatenate(interior)
+
+
+def grid_series(llat, llong, element, is_far, radius):
+    # loc_series for wide radii. Cells inside the radius are added up from
+    # grid_yearly, only the stations in cells it partly covers are read
+    # from station_year_temp, so the cost grows with the edge of the circle
+    # rather than its area. Like loc_series it lists only the stations in
+    # range that have data for the element
+    e_col = elements[element][0]
+    interior = grid_interior_cells(llat, llong, radius)
+    near = near_stations(llat, llong, radius)
+    used = station_elements[element][near["station_key"]]
+    near = {k: v[used] for k, v in near.items()}
+    in_interior = np.zeros(len(near["station_key"]), dtype=bool)
+    for level in range(len(grid_cell_degrees)):
+        in_interior |= np.isin(grid_cell_keys(level, near["Latitude"], near["Longitude"]), interior)
+    edge_keys = near["station_key"][~in_interior].tolist()
+    cell_keys = interior.tolist()
+    with db_pool.cursor() as cur:
+        parts = cur.execute(f"""
+        SELECT year,sum(n_{e_col})::DOUBLE AS n,sum(sum_{e_col})::DOUBLE AS total
+        FROM grid_yearly
+        WHERE cell_key BETWEEN ? AND ? AND cell_key IN (SELECT unnest(?::BIGINT[]))
+        GROUP BY year HAVING sum(n_{e_col}) > 0
+        UNION ALL
+        SELECT year,count({e_col})::DOUBLE AS n,sum({e_col})::DOUBLE AS total
+        FROM station_year_temp
+        WHERE station_key BETWEEN ? AND ?
+            AND station_key IN (SELECT unnest(?::INTEGER[])) AND {e_col} IS NOT NULL
+        GROUP BY year
+        """, [
+            min(cell_keys, default=0), max(cell_keys, default=-1), cell_keys,
+            min(edge_keys, default=0), max(edge_keys, default=-1), edge_keys,
+        ]).fetchnumpy()
+    # a year can have a row from each side
+    years, year_inds = np.unique(parts["year"], return_inverse=True)
+    year_n = np.bincount(year_inds, weights=parts["n"])
+    year_total = np.bincount(year_inds, weights=parts["total"])
+    year_avg = year_total / year_n
+    if is_far:
+        year_avg = (year_avg * 1.8) + 32
+    rv_temp = {"Year": years.tolist(), "avg": year_avg.tolist()}
+    by_dist = np.argsort(near["Dist"], kind="stable")
+    rv_stations = {
+        out_col: near[col][by_dist].tolist()
+        for out_col, col in (
+            ("ID", "ID"), ("name", "Name"), ("long", "Longitude"), ("lat", "Latitude"), ("dist", "Dist")
+        )
+    }
+    return rv_temp, rv_stations, trend_sums(years, year_avg)
+
+
+def load_station_matrix(matrix_dir):
+    # The stations x years matrices make_data.py exports, memory mapped so
+    # all worker processes share the same pages. They have to come from
+    # the same build as the database and agree on the station keys
+    with open(os.path.join(matrix_dir, "meta.json")) as fp:
+        meta = json.load(fp)
+    if meta["build_id"] != build_id:
+        raise RuntimeError(f"{matrix_dir} was exported from a different build than {db_file}")
+    coords = np.load(os.path.join(matrix_dir, "coords.npy"), mmap_mode="r")
+    st_coords = np.column_stack((station_data["Latitude"], station_data["Longitude"]))
+    if not np.array_equal(coords[station_data["station_key"]], st_coords):
+        raise RuntimeError(f"The station coordinates in {matrix_dir} don't match {db_file}")
+    years = np.load(os.path.join(matrix_dir, "years.npy"))
+    matrices = {
+        element: np.load(os.path.join(matrix_dir, f"{element}.npy"), mmap_mode="r")
+        for element in elements if element in meta["elements"]
+    }
+    return years, matrices
+
+
+if app.config["LOC_BACKEND"] == "matrix":
+    matrix_years, station_matrix = load_station_matrix(app.config["MATRIX_DIR"])
+
+
+def matrix_series(llat, llong, element, is_far, radius=radius_miles):
+    # loc_series from the memory mapped matrix, a row gather of the
+    # stations in range and a NaN aware mean over them, no SQL involved
+    near = near_stations(llat, llong, radius)
+    block = station_matrix[element][near["station_key"]]
+    has_value = ~np.isnan(block)
+    year_n = has_value.sum(axis=0)
+    year_total = np.nansum(block, axis=0, dtype=np.float64)
+    has_data = year_n > 0
+    years, year_avg = matrix_years[has_data].astype(np.int64), year_total[has_data] / year_n[has_data]
+    if is_far:
+        year_avg = (year_avg * 1.8) + 32
+    rv_temp = {"Year": years.tolist(), "avg": year_avg.tolist()}
+    used = has_value.any(axis=1)
+    by_dist = np.argsort(near["Dist"][used], kind="stable")
+    rv_stations = {
+        out_col: near[col][used][by_dist].tolist()
+        for out_col, col in (
+            ("ID", "ID"), ("name", "Name"), ("long", "Longitude"), ("lat", "Latitude"), ("dist", "Dist")
+        )
+    }
+    return rv_temp, rv_stations, trend_sums(years, year_avg)
+
+
+def check_matrix_backend(n_points=200, seed=0):
+    # Compares matrix_series with the SQL loc_series, the float32 matrix
+    # only agrees to about 7 significant digits
+    global matrix_years, station_matrix
+    matrix_years, station_matrix = load_station_matrix(app.config["MATRIX_DIR"])
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(station_data["ID"]), n_points)
+    n_bad = 0
+    for llat, llong in zip(station_data["Latitude"][picks] + rng.normal(0, .3, n_points), station_data["Longitude"][picks] + rng.normal(0, .3, n_points)):
+        for element in station_matrix:
+            m_temp, m_stations, _ = matrix_series(llat, llong, element, False)
+            s_temp, s_stations, _ = loc_series(llat, llong, element, False)
+            if not (
+                m_temp["Year"] == s_temp["Year"] and m_stations == s_stations
+                and np.allclose(m_temp["avg"], s_temp["avg"], rtol=1e-6)
+            ):
+                n_bad += 1
+                print(f"Mismatch at {llat}, {llong} for {element}")
+    print(f"{n_points * len(station_matrix) - n_bad}/{n_points * len(station_matrix)} matrix lookups match the SQL ones")
+    return n_bad == 0
+
+
+def snap_point(llat, llong):
+    # Nearby coordinates share a cache entry, 3 decimals is roughly 100m.
+    # Lookups are computed at the snapped point, so what a request gets
+    # doesn't depend on which nearby point filled the entry first
+    prec = app.config["LOC_CACHE_PRECISION"]
+    return round(llat, prec), round(llong, prec)
+
+
+def cached_loc_series(llat, llong, element, is_far, radius=radius_miles):
+    llat, llong = snap_point(llat, llong)
+    key = (llat, llong, element, is_far, radius)
+    rv = loc_cache.get(key)
+    if rv is None:
+        if app.config["LOC_BACKEND"] == "matrix":
+            rv = matrix_series(llat, llong, element, is_far, radius)
+        elif use_grid and radius >= app.config["GRID_MIN_RADIUS"]:
+            rv = grid_series(llat, llong, element, is_far, radius)
+        else:
+            rv = loc_series(llat, llong, element, is_far, radius)
+        loc_cache.put(key, rv)
+    return rv
+
+
+# Built by make_data.py, older databases compute every lookup
+use_place_series = "place_series" in table_names
+
+
+def place_series(place_key, element, is_far):
+    # loc_series of a zip or place from the rows make_data.py precomputed,
+    # None when there is no such row
+    if not use_place_series:
+        return None
+    with db_pool.cursor() as cur:
+        row = cur.execute(
+            "SELECT years,avgs,station_keys,station_dists FROM place_series "
+            "WHERE place_key = ? AND element = ?",
+            [place_key, element]
+        ).fetchone()
+    if row is None:
+        return None
+    years, avgs, st_keys, st_dists = row
+    avgs = np.asarray(avgs, dtype=float)
+    if is_far:
+        avgs = (avgs * 1.8) + 32
+    # station_data is ordered by station_key
+    st_rows = np.searchsorted(station_data["station_key"], st_keys)
+    rv_temp = {"Year": list(years), "avg": avgs.tolist()}
+    rv_stations = {
+        "ID": station_data["ID"][st_rows].tolist(),
+        "name": station_data["Name"][st_rows].tolist(),
+        "long": station_data["Longitude"][st_rows].tolist(),
+        "lat": station_data["Latitude"][st_rows].tolist(),
+        "dist": list(st_dists),
+    }
+    return rv_temp, rv_stations, trend_sums(years, avgs)
+
+
+def parse_radius(args):
+    # radius query argument in miles, radius_miles when left out
+    i_radius = si(args.get("radius", default=""))
+    if not i_radius:
+        return radius_miles
+    if not (is_float(i_radius) and 0 < float(i_radius) <= app.config["MAX_RADIUS_MILES"]):
+        raise RuntimeError(f"radius={i_radius}")
+    return float(i_radius)
+
+
+def resolve_location(args):
+    # (lat, long, inputted, element, is_far, place_key, radius) of /loc style
+    # query arguments, place_key is the place_series key of zips and places.
+    # Raises RuntimeError carrying the inputted text when they don't resolve
+    i_llat = si(args.get("lat", default=""))
+    i_llong = si(args.get("long", default=""))
+
+    lcity = si(args.get("city", default=""))
+    lst = si(args.get("state", default=""))
+
+    lzip = si(args.get("zip", default=""))
+    inputted = " ".join(map(str,[i_llat, i_llong, lcity, lst, lzip]))
+
+    place_key = None
+    if bool(i_llat) and bool(i_llong) and is_float(i_llat) and is_float(i_llong):
+        llat = i_llat
+        llong = i_llong
+        inputted = f"{i_llat}, {i_llong}"
+        # float() also takes nan and inf, which fail these comparisons
+        if not (abs(float(llat)) <= 90 and abs(float(llong)) <= 180):
+            raise RuntimeError(inputted)
+    elif bool(lzip) and is_int(lzip):
+        inputted = lzip
+        rv = geocode_zip(lzip)
+        if rv is None:
+            raise RuntimeError(inputted)
+        llat, llong = rv
+        place_key = f"zip:{int(lzip)}"
+    elif bool(lcity) and bool(lst):
+        inputted = f"{lcity}, {lst}"
+        rv = geocode_place(html.unescape(lcity), html.unescape(lst))
+        if rv is None:
+            raise RuntimeError(inputted)
+        llat, llong = rv
+        place_key = "place:{}|{}".format(
+            html.unescape(lst).strip().casefold(), html.unescape(lcity).strip().casefold()
+        )
+    else:
+        raise RuntimeError(inputted)
+
+    element = si(args.get("element", default="TMAX")).upper()
+    if element not in elements:
+        raise RuntimeError(inputted)
+    is_far = elements[element][2] and bool(si(args.get("use_f", default="")))
+    return float(llat), float(llong), inputted, element, is_far, place_key, parse_radius(args)
+
+
+def loc_payload(
+    llat, llong, inputted, element, is_far, place_key=None, radius=radius_miles,
+    start_year=None, end_year=None
+):
+    rv = None
+    if place_key is not None and radius == radius_miles and app.config["LOC_BACKEND"] != "matrix":
+        rv = place_series(place_key, element, is_far)
+    if rv is None:
+        rv = cached_loc_series(llat, llong, element, is_far, radius)
+    rv_temp, rv_stations, rv_sums = rv
+    # copied, the cached station list must not get the resolved location
+    rv_stations = {k: list(v) for k, v in rv_stations.items()}
+    rv_stations["ID"].append("")
+    rv_stations["name"].append("Resolved Location")
+    rv_stations["long"].append(llong)
+    rv_stations["lat"].append(llat)
+    rv_stations["dist"].append(0.)
+    _, y_title, is_temp, unit, label = elements[element]
+    return {
+        "inputted": inputted,
+        "element": element,
+        "label": label,
+        "y_title": y_title,
+        "unit": "°F" if is_far else unit,
+        "is_temp": is_temp,
+        "is_f": is_far,
+        "radius": radius,
+        "x": rv_temp["Year"],
+        "y": rv_temp["avg"],
+        "stations": rv_stations,
+        "trend": fit_trend(rv_sums, start_year, end_year),
+    }
+
+
+def everywhere_series(is_far):
+    has_data = global_yearly["n_average"] > 0
+    t_avg = global_yearly["sum_average"][has_data] / global_yearly["n_average"][has_data]
+    return global_yearly["year"][has_data], (t_avg * 1.8) + 32 if is_far else t_avg
+
+
+everywhere_sums = {is_far: trend_sums(*everywhere_series(is_far)) for is_far in (False, True)}
+
+
+def everywhere_payload(is_far, start_year=None, end_year=None):
+    years, t_avg = everywhere_series(is_far)
+    return {
+        "inputted": "Everywhere",
+        "element": "TMAX",
+        "label": element_info["TMAX"][0],
+        "y_title": element_info["TMAX"][1],
+        "unit": "°F" if is_far else element_info["TMAX"][2],
+        "is_temp": True,
+        "is_f": is_far,
+        "x": years.tolist(),
+        "y": t_avg.tolist(),
+        "stations": None,
+        "trend": fit_trend(everywhere_sums[is_far], start_year, end_year),
+    }
+
+
+def trend_payload(payload):
+    # Only the fit, for clients that don't need the series
+    return {k: v for k, v in payload.items() if k not in ("x", "y", "stations")}
+
+
+arrow_mimetype = "application/vnd.apache.arrow.stream"
+
+
+def payload_to_arrow(payload):
+    # The yearly series as the table, everything else as JSON schema metadata
+    import pyarrow as pa
+
+    table = pa.table({"year": payload.get("x", []), "value": payload.get("y", [])})
+    table = table.replace_schema_metadata({
+        k: json.dumps(v, separators=(",", ":"))
+        for k, v in payload.items() if k not in ("x", "y")
+    })
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def data_response(key, make_payload):
+    # Strong ETag from the build id, the settings that pick how a lookup is
+    # computed and the query key, so a matching If-None-Match is answered
+    # with a 304 before anything is queried. The body has to be a function
+    # of exactly these, which is why lookups run at the snapped coordinates
+    fmt = request.args.get("format") or request.accept_mimetypes.best_match(
+        ["application/json", arrow_mimetype], default="application/json"
+    )
+    fmt = "arrow" if fmt in ("arrow", arrow_mimetype) else "json"
+    if fmt == "arrow" and importlib.util.find_spec("pyarrow") is None:
+        abort(406)
+    settings = tuple(
+        app.config[k] for k in ("LOC_BACKEND", "LOC_CACHE_PRECISION", "GRID_MIN_RADIUS")
+    )
+    etag = hashlib.sha256(repr((build_id, fmt, settings) + key).encode()).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        rsp = Response(status=304)
+    elif fmt == "arrow":
+        rsp = Response(payload_to_arrow(make_payload()), mimetype=arrow_mimetype)
+    else:
+        rsp = Response(
+            json.dumps(make_payload(), separators=(",", ":")), mimetype="application/json"
+        )
+    rsp.set_etag(etag)
+    rsp.headers["Cache-Control"] = f"public, max-age={app.config['API_MAX_AGE']}"
+    rsp.vary.add("Accept")
+    return rsp
+
+
+def load_asset_manifest(asset_dir):
+    # Hashed names and compressed variants written by build_assets.py,
+    # without them assets are served from static as they are
+    try:
+        with open(os.path.join(asset_dir, "manifest.json")) as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        return {}, {}
+    variants = {
+        hashed: [
+            enc for enc, ext in asset_encodings.items()
+            if os.path.exists(os.path.join(asset_dir, hashed + ext))
+        ]
+        for hashed in manifest.values()
+    }
+    return manifest, variants
+
+
+asset_dir = os.path.join(app.static_folder, "dist")
+asset_encodings = {"br": ".br", "gzip": ".gz"}
+asset_manifest, asset_variants = load_asset_manifest(asset_dir)
+
+
+def asset_url(name):
+    hashed = asset_manifest.get(name)
+    if hashed is None:
+        return url_for("static", filename=name)
+    return url_for("hashed_asset", filename=hashed)
+
+
+@app.context_processor
+def asset_helpers():
+    return {"asset_url": asset_url}
+
+
 @app.errorhandler(404)
 def not_found(e):
   return render_template("404.jinja2")
 
-@app.route('/everywhere', methods=['GET'])
-def everywhere():
+@app.route('/api/everywhere', methods=['GET'])
+@app.route('/api/everywhere/trend', methods=['GET'], endpoint="api_everywhere_trend")
+def api_everywhere():
     is_far = bool(si(request.args.get("use_f", default="")))
-    t_expr = "((Average * 1.8) + 32)" if is_far else "Average"
-    rv_data = con.execute(f"SELECT Year,AVG({t_expr}) AS T_Average FROM loc_to_temp GROUP BY Year").df().to_dict(orient='list')
+    try:
+        years = year_range(request.args)
+    except RuntimeError as e:
+        return jsonify(error=f"Bad Input or None Found! {e}"), 400
+    if request.endpoint == "api_everywhere_trend":
+        return data_response(
+            ("everywhere_trend", is_far) + years,
+            lambda: trend_payload(everywhere_payload(is_far, *years))
+        )
+    return data_response(("everywhere", is_far) + years, lambda: everywhere_payload(is_far, *years))
 
+@app.route('/api/loc', methods=['GET'])
+@app.route('/api/loc/trend', methods=['GET'], endpoint="api_loc_trend")
+def api_loc():
+    try:
+        loc = resolve_location(request.args)
+        years = year_range(request.args)
+    except RuntimeError as e:
+        return jsonify(error=f"Bad Input or None Found! {e}"), 400
+    if request.endpoint == "api_loc_trend":
+        return data_response(
+            ("loc_trend",) + loc + years, lambda: trend_payload(loc_payload(*loc, *years))
+        )
+    return data_response(("loc",) + loc + years, lambda: loc_payload(*loc, *years))
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    # {"locations": [{"zip": ...}, {"city": ..., "state": ...}, {"lat": ..., "long": ...}],
+    #  "element": ..., "use_f": ..., "start_year": ..., "end_year": ...}
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("locations"), list):
+        return jsonify(error="Expected a JSON object with a list of locations"), 400
+    max_size = app.config["BATCH_MAX_SIZE"]
+    if len(body["locations"]) > max_size:
+        return jsonify(error=f"At most {max_size} locations per batch"), 413
+    shared = {
+        k: str(body[k]) for k in ("element", "start_year", "end_year", "radius")
+        if body.get(k) is not None
+    }
+    shared["use_f"] = "1" if body.get("use_f") else ""
+    element = si(shared.get("element", "TMAX")).upper()
+    try:
+        if element not in elements:
+            raise RuntimeError(f"element={element}")
+        start_year, end_year = year_range(MultiDict(shared))
+        radius = parse_radius(MultiDict(shared))
+    except RuntimeError as e:
+        return jsonify(error=f"Bad Input or None Found! {e}"), 400
+    _, y_title, is_temp, unit, label = elements[element]
+    is_far = is_temp and bool(shared["use_f"])
+
+    # Every location is checked on its own, so one bad entry only fails its
+    # own result and batch_series never sees coordinates it can't query
+    results = [None] * len(body["locations"])
+    resolved = []
+    for i, location in enumerate(body["locations"]):
+        if not isinstance(location, dict):
+            results[i] = {"error": "Bad Input or None Found!"}
+            continue
+        args = MultiDict({**{k: str(v) for k, v in location.items()}, **shared})
+        try:
+            resolved.append((i, resolve_location(args)))
+        except RuntimeError as e:
+            results[i] = {"inputted": str(e), "error": f"Bad Input or None Found! {e}"}
+
+    series = batch_series([snap_point(*loc[:2]) for _, loc in resolved], element, is_far, radius)
+    for (i, (llat, llong, inputted, *_)), (rv_temp, n_stations, rv_sums) in zip(resolved, series):
+        results[i] = {
+            "inputted": inputted,
+            "lat": llat,
+            "long": llong,
+            "n_stations": n_stations,
+            "x": rv_temp["Year"],
+            "y": rv_temp["avg"],
+            "trend": fit_trend(rv_sums, start_year, end_year),
+        }
+    return jsonify(
+        element=element, label=label, y_title=y_title, unit="°F" if is_far else unit,
+        is_temp=is_temp, is_f=is_far, results=results
+    )
+
+@app.route('/everywhere', methods=['GET'])
+def everywhere():
+    # The page is a shell, its data is fetched from /api/everywhere
     return render_template(
         "plot.jinja2",
         inputted="Everywhere",
-        stations = "",
-        x_pts = rv_data["Year"],
-        y_pts = rv_data["T_Average"],
-        is_f = is_far
+        data_url=url_for("api_everywhere", **request.args),
     )
 
 @app.route('/loc', methods=['GET'])
 def get_data():
-    i_llat = si(request.args.get("lat", default=""))
-    i_llong = si(request.args.get("long", default=""))
-
-    lcity = si(request.args.get("city", default=""))
-    lst = si(request.args.get("state", default=""))
-
-    lzip = si(request.args.get("zip", default=""))
-    inputted = " ".join(map(str,[i_llat, i_llong, lcity, lst, lzip]))
-
-    llat = -99.
-    llong = -99.
     try:
-        if bool(i_llat) and bool(i_llong) and is_float(i_llat) and is_float(i_llong):
-            llat = i_llat
-            llong = i_llong
-            inputted = f"{i_llat}, {i_llong}"
-        elif bool(lzip) and is_int(lzip):
-            inputted = lzip
-            con.execute("""
-            SELECT INTPTLAT,INTPTLONG
-            FROM place_zips
-            WHERE GEOID = ?
-            """, [lzip]
-            )
-            rv = con.fetchone()
-            if rv is None:
-                raise RuntimeError
-            llat, llong = rv
-        elif bool(lcity) and bool(lst):
-            inputted = f"{lcity}, {lst}"
-            con.execute("""
-            SELECT INTPTLAT,INTPTLONG
-            FROM place_names
-            WHERE USPS = ? AND NAME ILIKE ?
-            """, [lst, lcity]
-            )
-            rv = con.fetchone()
-            if rv is None:
-                raise RuntimeError
-            llat, llong = rv
-        else:
-            raise RuntimeError
-
-        is_far = bool(si(request.args.get("use_f", default="")))
-        t_expr = "((Average * 1.8) + 32)" if is_far else "Average"
-        con.execute(f"""
-        SELECT ID,Year,{t_expr} AS Average,Name,Longitude,Latitude,gad(Longitude, Latitude, ?, ?)*69 AS Dist
-        FROM loc_to_temp
-        WHERE Dist < 35
-        """, [llong, llat]
-        ) 
-        # the conversions aren't exact, but a roughly 
-        # 35 mile radius seems right based on NOAA queries
-    except RuntimeError:
-            return render_template(
-                'error.jinja2',
-                msg=f"Bad Input or None Found! {inputted}"
-            )
-    
-    rv_data = con.df()
-    rv_temp = con.execute("SELECT Year,AVG(Average) AS avg FROM 'rv_data' GROUP BY Year ORDER BY Year").df().to_dict(orient='list')
-    rv_stations = con.execute(
-        "SELECT ID,first(Name) AS name,first(longitude) AS long,"
-        "first(latitude) AS lat,first(Dist) AS dist "
-        "FROM 'rv_data' GROUP BY ID Order BY dist"
-    ).df().to_dict(orient='list')
-
-    rv_stations["ID"].append("")
-    rv_stations["name"].append("Resolved Location")
-    rv_stations["long"].append(llong)
-    rv_stations["lat"].append(llat)
-    rv_stations["dist"].append(0.)
+        inputted = resolve_location(request.args)[2]
+    except RuntimeError as e:
+        return render_template(
+            'error.jinja2',
+            msg=f"Bad Input or None Found! {e}"
+        )
 
     return render_template(
         "plot.jinja2",
-        inputted = inputted,
-        stations = rv_stations,
-        x_pts = rv_temp["Year"],
-        y_pts = rv_temp["avg"],
-        is_f = is_far
+        inputted=inputted,
+        data_url=url_for("api_loc", **request.args),
     )
 
 
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(loc_cache.stats())
+
+
+@app.route('/assets/<path:filename>')
+def hashed_asset(filename):
+    # The name changes with the content, so it can be cached for good
+    if filename not in asset_variants:
+        abort(404)
+    enc = request.accept_encodings.best_match(asset_variants[filename])
+    rsp = send_from_directory(
+        asset_dir,
+        filename + asset_encodings[enc] if enc else filename,
+        mimetype=mimetypes.guess_type(filename)[0],
+    )
+    if enc:
+        rsp.headers["Content-Encoding"] = enc
+    rsp.vary.add("Accept-Encoding")
+    rsp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return rsp
+
 @app.route('/plot_test')
 def plot_test():
     return render_template("plot_test.jinja2")
 
 @app.route('/')
 def index_page():
-    return render_template('index.jinja2')
+    return render_template('index.jinja2', elements=element_labels)
 
 @app.route('/<path:filename>')
 def protected(filename):
 	abort(404)
 
 if __name__ == '__main__':
+    if "--check-index" in sys.argv[1:]:
+        sys.exit(0 if check_station_index() else 1)
+    if "--check-concurrency" in sys.argv[1:]:
+        sys.exit(0 if check_concurrency() else 1)
+    if "--check-matrix" in sys.argv[1:]:
+        sys.exit(0 if check_matrix_backend() else 1)
     app.run(host='127.0.0.1', port=10420)